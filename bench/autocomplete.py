@@ -0,0 +1,47 @@
+from os import environ
+from sys import argv
+from random import Random
+from timeit import repeat
+
+environ.setdefault('DM_SHEET', 'https://docs.google.com/spreadsheets/d/bench')
+
+from ext.loop import running
+
+from ext.utils import AutocompleteIndex
+
+# `python -m bench.autocomplete [monsters]` times AutocompleteIndex against the linear scan monster_autocomplete used to do
+
+SYLLABLES = ('gob', 'lin', 'or', 'c', 'dra', 'gon', 'tro', 'll', 'ske', 'le', 'ton', 'wy', 'vern', 'ba', 'si', 'lisk', 'ky', 'ma', 'ra', 'ett', 'in')
+KINDS = ('', ' Lord', ' King', ' Shaman', ' Warrior', ' Elder', ' Spawn', ' Brute')
+
+
+def names(count, rng):
+    found = set()
+    while len(found) < count:
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).title() + rng.choice(KINDS)
+        found.add(name)
+    return sorted(found)
+
+
+def timed(function, number=200): # Best of 5, in microseconds per call
+    return min(repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+if __name__ == '__main__':
+    with running():
+        count = int(argv[1]) if len(argv) > 1 else 5000
+        monsters = names(count, Random(0))
+        index = AutocompleteIndex(monsters)
+        print(f"{count} monsters, index built in {timed(lambda: AutocompleteIndex(monsters), 3) / 1000:.1f}ms")
+
+        queries = {
+          'empty': '',
+          'prefix': monsters[count // 2][:3],
+          'long prefix': monsters[count // 2][:8],
+          'substring': 'lisk',
+          'fuzzy': 'drgaon',
+        }
+        for kind, query in queries.items():
+            linear = timed(lambda: [name for name in monsters if query.title() in name])
+            indexed = timed(lambda: index.search(query))
+            print(f"{kind + ' ' + repr(query) + ':':26} linear scan {linear:8.1f}us ({len([name for name in monsters if query.title() in name])} results), index {indexed:7.1f}us ({len(index.search(query))} results)")
@@ -0,0 +1,93 @@
+from os import environ
+from sys import argv
+from random import Random
+from tracemalloc import start, stop, take_snapshot, reset_peak, get_traced_memory
+
+environ.setdefault('DM_SHEET', 'https://docs.google.com/spreadsheets/d/bench')
+
+from ext.loop import running
+
+from ext.utils import Character, Item, Arrow, PreciousMaterial, SN, SNAPSHOT, YAML_CLASSES
+from ext.snapshot import SnapshotCodec
+
+# `python -m bench.characters [characters]` measures the memory synthetic characters take, the old way (a __dict__ each
+# and every inventory made up front) against the slotted Character with lazy inventories. Loaded from a snapshot is what the
+# bot actually holds after starting, nothing is shared between characters then
+
+
+class EagerInventory(object): # Inventory and Character as they were before slots
+    def __init__(self, limiter, weight=0, type=Item):
+        self.limiter = limiter
+        self.weight = weight
+        self.type = type
+        self.inv = []
+
+
+class EagerCharacter(object):
+    def __init__(self, name, race, eyes, hair, age, gender, verbs, pronouns, height, weight, level, fpm, image, yen, base, mods):
+        self.name = name
+        self.race = race
+        self.eyes = eyes
+        self.hair = hair
+        self.age = age
+        self.gender = gender
+        self.verbs = verbs
+        self.pronouns = pronouns
+        self.height = height
+        self.weight = weight
+        self.level = level
+        self.image = image
+        self.yen = yen
+        self.stats = SN(base=base, mods=mods)
+        self.fpm = fpm
+        self.body_inv = EagerInventory(9)
+        self.belt_pouch = EagerInventory(12, 1)
+        self.quiver = EagerInventory(6, 1, Arrow)
+        self.backpack = EagerInventory(6, 5)
+        self.bag_of_holding = EagerInventory(0, 15)
+        self.bpa = False
+        self.boha = False
+        self.gems = EagerInventory(6, type=PreciousMaterial)
+        self.valuables = EagerInventory(7, type=PreciousMaterial)
+
+
+def fields(i, rng): # Arguments for either class, strings are made per character like they would be when loaded
+    stats = {stat: rng.randint(3, 18) for stat in ('str', 'dex', 'con', 'int', 'wis', 'cha')}
+    return (
+      f"Character {i}", rng.choice(("Human", "Elf", "Dwarf", "Halfling")), "brown", "black", rng.randint(16, 300), "female",
+      ("is", "has"), ("she", "her", "herself"), "5'6\"", "130 lbs", rng.randint(1, 20), 30,
+      f"https://example.com/{i}.png", rng.randint(0, 10000), SN(**stats), SN(**{stat: (value - 10) // 2 for stat, value in stats.items()}),
+    )
+
+
+def measure(build): # Bytes still allocated once `build` returns, the result is kept alive until then
+    start()
+    reset_peak()
+    result = build()
+    used = get_traced_memory()[0]
+    stop()
+    return used, result
+
+
+if __name__ == '__main__':
+    with running():
+        count = int(argv[1]) if len(argv) > 1 else 10000
+        codec = SnapshotCodec(YAML_CLASSES + [EagerCharacter, EagerInventory])
+        results = {}
+        for name, cls in (('Eager inventories, __dict__', EagerCharacter), ('Lazy inventories, slotted', Character)):
+            built, chars = measure(lambda: {i: cls(*fields(i, Random(i))) for i in range(count)})
+            blob = codec.dumps(chars)
+            loaded, _ = measure(lambda: codec.loads(blob))
+            results[name] = (built, loaded, len(blob))
+
+        for char in chars.values(): # A tenth of the players actually carry something
+            if char.level > 18:
+                char.body_inv.add(Item("Rope", 10))
+                char.gems.add(PreciousMaterial("Ruby", 0, 500))
+        blob = codec.dumps(chars)
+        carrying, _ = measure(lambda: codec.loads(blob))
+
+        print(f"{count} characters        built     loaded from a snapshot")
+        for name, (built, loaded, size) in results.items():
+            print(f"{name + ':':30} {built / 2**20:5.1f}MB   {loaded / 2**20:5.1f}MB ({loaded // count} bytes each, {size / 2**20:.1f}MB snapshot)")
+        print(f"{'Lazy, a tenth carrying items:':30}           {carrying / 2**20:5.1f}MB")
@@ -0,0 +1,104 @@
+from os import environ
+from sys import argv, executable
+from subprocess import Popen, DEVNULL
+from time import perf_counter
+import asyncio
+import socket
+
+environ.setdefault('DM_SHEET', 'https://docs.google.com/spreadsheets/d/bench')
+
+from ext.loop import running, stop_kokoro
+from fastapi import FastAPI, Request
+from fastapi.templating import Jinja2Templates
+from starlette.responses import HTMLResponse
+
+from ext.web import StaticAssets, PageRenderer
+
+# `python -m bench.dashboard [seconds] [connections]` load tests the dashboard pages on a local uvicorn, first rendered
+# with TemplateResponse on every request like minihatas/web.py used to, then through PageRenderer
+
+NAME = "Bench User#0001"
+CHARACTER = "Bench Character"
+
+templates = Jinja2Templates(directory="templates")
+assets = StaticAssets('static')
+templates.env.globals['static_url'] = assets.url
+pages = PageRenderer(templates, static=('logout.html',))
+
+before = FastAPI()
+after = FastAPI()
+
+@before.get('/')
+async def before_home(req:Request):
+    return templates.TemplateResponse(req, "index.html", {"name": NAME, "character": CHARACTER})
+
+@before.get('/logout')
+async def before_logout(req:Request):
+    return templates.TemplateResponse(req, "logout.html")
+
+@after.get('/')
+async def after_home(req:Request):
+    return HTMLResponse(pages.cached("index.html", (0, NAME, CHARACTER), name=NAME, character=CHARACTER))
+
+@after.get('/logout')
+async def after_logout(req:Request):
+    return HTMLResponse(pages.page("logout.html"))
+
+for app in (before, after):
+    app.on_event('shutdown')(stop_kokoro)
+
+
+async def hammer(port, path, seconds): # One keep-alive connection sending requests back to back, returns how many got a 200
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode()
+    done = 0
+    end = perf_counter() + seconds
+    try:
+        while perf_counter() < end:
+            writer.write(request)
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = int(head.lower().split(b'content-length:')[1].split(b'\r\n')[0])
+            await reader.readexactly(length)
+            if head.startswith(b'HTTP/1.1 200'):
+                done += 1
+    finally:
+        writer.close()
+    return done
+
+
+async def load(port, path, seconds, connections):
+    results = await asyncio.gather(*(hammer(port, path, seconds) for _ in range(connections)))
+    return sum(results) / seconds
+
+
+def wait_for(port, process):
+    while process.poll() is None:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            pass
+    raise RuntimeError("uvicorn didn't start")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+if __name__ == '__main__':
+    with running():
+        seconds = float(argv[1]) if len(argv) > 1 else 5
+        connections = int(argv[2]) if len(argv) > 2 else 16
+        print(f"{connections} connections, {seconds:g}s per page, one uvicorn worker")
+        for name in ('before', 'after'):
+            port = free_port()
+            server = Popen([executable, '-m', 'uvicorn', f'bench.dashboard:{name}', '--port', str(port), '--log-level', 'warning'], stdout=DEVNULL)
+            try:
+                wait_for(port, server)
+                for path in ('/', '/logout'):
+                    print(f"{name:6} {path:8} {asyncio.run(load(port, path, seconds, connections)):8.0f} requests/s")
+            finally:
+                server.terminate()
+                server.wait(10)
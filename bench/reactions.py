@@ -0,0 +1,72 @@
+from sys import argv
+from time import perf_counter
+from types import SimpleNamespace as SN
+from random import Random
+from asyncio import run
+
+from ext.reactions import ReactionRouter
+
+# `python -m bench.reactions [events]` replays a synthetic reaction stream through ReactionRouter and through the
+# linear scans minihatas/misc.py and minihatas/web.py used to do for every reaction
+
+CLIENT = SN(id=0)
+ROLE_MESSAGE = 1
+UPDATE_MESSAGES = [2, 3, 4]
+EMOJIS = [SN(id=i) for i in range(100, 105)]
+handled = 0
+
+
+async def handler(client, event):
+    global handled
+    handled += 1
+
+
+def events(count, rng): # 1% of reactions are on messages the bot cares about, like a busy server
+    found = []
+    for _ in range(count):
+        message_id = rng.choice((ROLE_MESSAGE, *UPDATE_MESSAGES)) if rng.random() < 0.01 else rng.randrange(10, 100000)
+        found.append(SN(message=SN(id=message_id), emoji=rng.choice(EMOJIS + [SN(id=rng.randrange(1000))]), user=SN(id=rng.randrange(1, 1000))))
+    return found
+
+
+async def old(event):
+    if event.user.id == CLIENT.id:
+        return
+    if event.message.id in UPDATE_MESSAGES:
+        UPDATE_MESSAGES.index(event.message.id)
+    if not event.message.id == ROLE_MESSAGE:
+        return
+    rolemoji = None
+    for emoji in EMOJIS:
+        if emoji.id == event.emoji.id:
+            rolemoji = emoji
+    if rolemoji:
+        await handler(CLIENT, event)
+
+
+async def replay(dispatch, stream):
+    start = perf_counter()
+    for event in stream:
+        await dispatch(event)
+    return perf_counter() - start
+
+
+async def main(count):
+    global handled
+    router = ReactionRouter()
+    for emoji in EMOJIS:
+        router.add(ROLE_MESSAGE, emoji, handler, handler)
+    for message_id in UPDATE_MESSAGES:
+        router.add(message_id, EMOJIS[0], handler)
+    stream = events(count, Random(0))
+
+    baseline = await replay(old, stream)
+    handled = 0
+    routed = await replay(lambda event: router.reaction_add(CLIENT, event), stream)
+    print(f"{count} reactions, {handled} handled")
+    print(f"Linear scans: {baseline:.3f}s ({count / baseline:,.0f}/s)")
+    print(f"Router:       {routed:.3f}s ({count / routed:,.0f}/s)")
+
+
+if __name__ == '__main__':
+    run(main(int(argv[1]) if len(argv) > 1 else 1000000))
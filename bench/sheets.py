@@ -0,0 +1,95 @@
+from os import environ
+from sys import argv
+from time import perf_counter
+from threading import Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from json import dumps
+import time
+
+environ.setdefault('DM_SHEET', 'https://docs.google.com/spreadsheets/d/bench')
+
+from ext.loop import kokoro_asyncio, running
+asyncio = kokoro_asyncio()
+from requests import Session
+from requests.adapters import HTTPAdapter
+import gspread
+import gspread_asyncio
+
+from ext.utils import SheetsManager, batch_get, SheetRanges, FRONT_RANGES, DATA_RANGES, BACK_RANGES
+
+# `python -m bench.sheets [loads] [latency]` loads character sheets from a local fake Sheets API through
+# gspread_asyncio's own client manager and through SheetsManager, every load sending the two batchGets CharSpreadsheet.load does
+
+
+class FakeSheets(BaseHTTPRequestHandler): # Answers the two Sheets API calls a load makes, after `latency` seconds like a real round trip
+    latency = 0.2
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urlsplit(self.path)
+        key = url.path.split('/')[3].split(':')[0]
+        if url.path.endswith('values:batchGet'):
+            body = {'spreadsheetId': key, 'valueRanges': [{'range': rng, 'values': [['1']]} for rng in parse_qs(url.query)['ranges']]}
+        else: # Metadata, from opening the spreadsheet
+            body = {'spreadsheetId': key, 'properties': {'title': key}, 'sheets': []}
+        data = dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Redirect(HTTPAdapter): # Sends what gspread meant for Google to the fake server
+    def __init__(self, base):
+        super().__init__(pool_maxsize=32)
+        self.base = base
+
+    def send(self, request, **kwargs):
+        request.url = request.url.replace('https://sheets.googleapis.com', self.base)
+        return super().send(request, **kwargs)
+
+
+async def load(doc): # The same requests as CharSpreadsheet.load
+    fs, bs, data = SheetRanges(), SheetRanges(), SheetRanges()
+    await asyncio.gather(
+      batch_get(doc, [(fs, 'Front', rng) for rng in FRONT_RANGES] + [(data, 'Data', rng) for rng in DATA_RANGES]),
+      batch_get(doc, [(bs, 'Back', rng) for rng in BACK_RANGES], unformatted=True),
+    )
+
+
+async def run(manager, session, loads):
+    client = gspread_asyncio.AsyncioGspreadClient(manager, gspread.Client(None, session=session))
+    docs = [await client.open_by_key(f'sheet{i}') for i in range(loads)]
+    start = perf_counter()
+    await asyncio.gather(*(load(doc) for doc in docs))
+    return perf_counter() - start
+
+
+async def main(loads, base):
+    session = Session()
+    session.mount('https://', Redirect(base))
+    results = [
+      ("gspread_asyncio, 1.1s delay", gspread_asyncio.AsyncioGspreadClientManager(None)),
+      ("gspread_asyncio, no delay", gspread_asyncio.AsyncioGspreadClientManager(None, gspread_delay=0)),
+      ("SheetsManager, 4 at once", SheetsManager(None, asyncio.Semaphore(4))),
+    ]
+    print(f"{loads} sheet loads, {loads * 2} batchGets, {FakeSheets.latency * 1000:.0f}ms per request")
+    for name, manager in results:
+        print(f"{name + ':':30} {await run(manager, session, loads):.2f}s")
+
+
+if __name__ == '__main__':
+    loads = int(argv[1]) if len(argv) > 1 else 8
+    FakeSheets.latency = float(argv[2]) if len(argv) > 2 else 0.2
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSheets)
+    Thread(target=server.serve_forever, daemon=True).start()
+    with running() as loop:
+        try:
+            loop.run(main(loads, f"http://127.0.0.1:{server.server_address[1]}"))
+        finally:
+            server.shutdown()
@@ -0,0 +1,109 @@
+from json import dumps, loads
+from os import remove
+from contextlib import suppress
+from itertools import count
+import asyncio # The asyncio compatibility layer in the bot process, plain asyncio in web workers
+
+from ext.utils import Logger
+
+# Lets web workers running in other processes ask the bot to do things, over a Unix socket on the same machine.
+# Every message is a line of JSON. Requests look like {"id": 1, "action": "login", "args": {...}}
+# and get answered with {"id": 1, "result": ...} or {"id": 1, "error": "..."}, not necessarily in order
+
+
+class BridgeError(Exception): # The bot process raised while handling a request
+    pass
+
+
+class BridgeServer(object): # Runs on KOKORO in the bot process, calls `actions` on the backend for each request
+    def __init__(self, backend, path, actions):
+        self.backend = backend
+        self.path = path
+        self.actions = frozenset(actions) # Only these backend methods can be called from a worker
+        self.server = None
+
+    async def start(self):
+        with suppress(FileNotFoundError): # Left behind by a previous run
+            remove(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+        Logger.info('Bridge', f"Listening for web workers on {self.path}")
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    async def _serve(self, reader, writer): # One connection per worker, kept open for as long as the worker runs
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                asyncio.ensure_future(self._answer(loads(line), writer)) # So a slow OAuth request doesn't hold up everything behind it
+        except (ConnectionError, ValueError) as e:
+            Logger.error('Bridge', "Dropped a worker connection:", repr(e))
+        finally:
+            writer.close()
+
+    async def _answer(self, request, writer):
+        response = {'id': request['id']}
+        try:
+            if request['action'] not in self.actions:
+                raise BridgeError(f"Unknown action {request['action']!r}")
+            response['result'] = await getattr(self.backend, request['action'])(**request.get('args', {}))
+        except Exception as e:
+            response['error'] = repr(e)
+        with suppress(ConnectionError): # The worker went away, nobody's waiting for this anymore
+            writer.write(dumps(response).encode() + b'\n')
+
+
+class BridgeClient(object): # Used in web workers, a single connection that any number of requests can share
+    def __init__(self, path, timeout=15):
+        self.path = path
+        self.timeout = timeout
+        self.ids = count()
+        self.waiters = {} # Request ID -> future for its response
+        self.writer = None
+        self.connecting = None # Set while connecting so concurrent calls share one connection
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        asyncio.ensure_future(self._read(reader))
+        self.writer = writer
+
+    async def _read(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = loads(line)
+                future = self.waiters.pop(response['id'], None)
+                if future is None or future.done(): # Timed out already
+                    continue
+                if 'error' in response:
+                    future.set_exception(BridgeError(response['error']))
+                else:
+                    future.set_result(response['result'])
+        finally: # The bot went away, fail everything waiting and reconnect on the next call
+            self.writer = None
+            waiters, self.waiters = self.waiters, {}
+            for future in waiters.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the connection to the bot"))
+
+    async def call(self, action, **args):
+        if self.writer is None:
+            if self.connecting is None:
+                self.connecting = asyncio.ensure_future(self._connect())
+            try:
+                await self.connecting
+            finally:
+                self.connecting = None
+        id = next(self.ids)
+        future = self.waiters[id] = asyncio.get_running_loop().create_future()
+        self.writer.write(dumps({'id': id, 'action': action, 'args': args}).encode() + b'\n')
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.waiters.pop(id, None)
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from time import monotonic
+import asyncio
+
+from hata import KOKORO
+
+try:
+    from scarletio.http_client import HTTPClient as LoopHTTPClient
+except ImportError: # Older scarletio exports it at the top
+    from scarletio import HTTPClient as LoopHTTPClient
+
+
+# Google Sheets requests don't go through here, gspread sends them with requests and google-auth's AuthorizedSession
+# in a worker thread. That session already pools its connections and agcm.authorize() hands back the same client every time
+
+class HTTPClient(object): # One pooled client on KOKORO for the bot's own outbound requests (image checks), so connections (and their TLS handshakes) get reused
+    def __init__(self, timeout=10.0, ttl=600, failure_ttl=60, size=1024):
+        self.timeout = timeout # Seconds before a request is given up on
+        self.ttl = ttl # Seconds a working URL is trusted for before it's checked again
+        self.failure_ttl = failure_ttl # Shorter, so a host that was briefly down gets another chance soon
+        self.size = size # URL checks remembered, oldest are dropped first
+        self.checks = OrderedDict() # URL -> (whether it worked, when it expires)
+        self.client = None
+
+    @property
+    def session(self): # Made on first use, keeps its connections alive between requests
+        if self.client is None:
+            self.client = LoopHTTPClient(KOKORO)
+        return self.client
+
+    async def get(self, url, **kwargs): # Returns (status, body)
+        async with self.session.get(url, **kwargs) as response:
+            return response.status, await response.read()
+
+    async def url_ok(self, url): # Whether a URL (like a character's image) answers with a 200, cached per URL
+        now = monotonic()
+        cached = self.checks.get(url)
+        if cached is not None and now < cached[1]:
+            self.checks.move_to_end(url)
+            return cached[0]
+
+        try:
+            ok = await asyncio.wait_for(self._check(url), self.timeout)
+        except (OSError, ValueError, TypeError, asyncio.TimeoutError): # TypeError for a missing URL, like the original check
+            ok = False
+        self.checks[url] = (ok, now + (self.ttl if ok else self.failure_ttl))
+        self.checks.move_to_end(url)
+        if len(self.checks) > self.size:
+            self.checks.popitem(last=False)
+        return ok
+
+    async def _check(self, url):
+        async with self.session.head(url) as response: # Just the headers, the image itself is never downloaded
+            status = response.status
+        if status in (405, 501): # Hosts that don't do HEAD, the body of the GET is never read
+            async with self.session.get(url) as response:
+                status = response.status
+        return status == 200
+
+    async def aclose(self): # Call on shutdown
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+
+HTTP = HTTPClient() # Shared by everything in the process
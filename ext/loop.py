@@ -0,0 +1,21 @@
+# For anything using ext/ without main.py running the bot: tests, benchmarks and web workers
+from contextlib import contextmanager
+
+from hata import KOKORO
+
+
+def kokoro_asyncio(): # Swaps in scarletio's asyncio, so asyncio code runs on KOKORO like it does in main.py. Call it before anything else
+    from scarletio.ext import asyncio # uses asyncio, and never under uvicorn, which needs the real one
+    return asyncio
+
+
+def stop_kokoro(*args): # Importing hata starts its event loop thread, which keeps the process from exiting until it's stopped
+    KOKORO.stop()
+
+
+@contextmanager
+def running(): # Stops KOKORO however the block ends, for scripts
+    try:
+        yield KOKORO
+    finally:
+        stop_kokoro()
@@ -0,0 +1,37 @@
+class ReactionRouter(object): # The only reaction_add/reaction_delete handlers, reactions nobody cares about cost one set lookup
+    def __init__(self):
+        self.messages = {} # Message ID -> how many routes are on it
+        self.routes = {} # (message ID, emoji ID) -> (added, removed), either can be None
+
+    def add(self, message_id, emoji, added=None, removed=None): # Handlers are coroutine functions taking (client, event), replaces any route already there
+        key = (message_id, emoji.id)
+        if key not in self.routes:
+            self.messages[message_id] = self.messages.get(message_id, 0) + 1
+        self.routes[key] = (added, removed)
+
+    def remove(self, message_id, emoji=None): # Without an emoji, every route on the message goes
+        if emoji is None:
+            keys = [key for key in self.routes if key[0] == message_id]
+        else:
+            keys = [(message_id, emoji.id)]
+        for key in keys:
+            if self.routes.pop(key, None) is not None:
+                self.messages[message_id] -= 1
+        if not self.messages.get(message_id, 1):
+            del self.messages[message_id]
+
+    def _route(self, client, event):
+        if event.message.id not in self.messages or event.user.id == client.id:
+            return None
+        return self.routes.get((event.message.id, event.emoji.id))
+
+    async def reaction_add(self, client, event):
+        route = self._route(client, event)
+        if route is not None and route[0] is not None:
+            await route[0](client, event)
+
+    async def reaction_delete(self, client, event):
+        route = self._route(client, event)
+        if route is not None and route[1] is not None:
+            await route[1](client, event)
+
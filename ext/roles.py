@@ -0,0 +1,131 @@
+from contextlib import suppress
+from time import monotonic
+import asyncio
+
+from hata import DiscordException, ERROR_CODES, KOKORO
+
+from ext.utils import Logger
+
+
+class RoleReconciler(object): # Makes the reaction roles match the reactions on a message, only sending requests for what's actually different
+    def __init__(self, client, message, rolemojis, concurrency=4, interval=2.0):
+        self.client = client
+        self.message = message # (channel ID, message ID) the reactions are on
+        self.rolemojis = rolemojis
+        self.concurrency = concurrency # Requests in flight per route, hata still waits out each route's rate limit bucket on top of this
+        self.interval = interval # Seconds between progress reports
+
+    async def plan(self): # Returns ([(route, user, rolemoji)], {rolemoji: members with the role once the plan is applied})
+        changes = []
+        counts = {}
+        for rolemoji in self.rolemojis:
+            guild = rolemoji.role.guild
+            reactors = await self.client.reaction_user_get_all(self.message, rolemoji.emoji)
+            if not any(reactor.id == self.client.id for reactor in reactors): # So people can just click it
+                with suppress(DiscordException):
+                    await self.client.reaction_add(self.message, rolemoji.emoji)
+
+            wanted = set()
+            for reactor in reactors:
+                if reactor.id == self.client.id:
+                    continue
+                wanted.add(reactor.id)
+                if not reactor.has_role(rolemoji.role): # Members missing from the cache (it may not be chunked yet) land here too, _apply finds out if they left
+                    changes.append(('user_role_add', reactor, rolemoji))
+            for user in guild.users.values():
+                if user.id not in wanted and user.has_role(rolemoji.role):
+                    changes.append(('user_role_delete', user, rolemoji))
+            counts[rolemoji] = len(wanted)
+        return changes, counts
+
+    async def _apply(self, route, user, rolemoji):
+        if route == 'user_role_delete':
+            await self.client.user_role_delete(user, rolemoji.role, reason="Recalculating roles")
+            return
+        try:
+            await self.client.user_role_add(user, rolemoji.role, reason="User reacted to "+rolemoji.name)
+        except DiscordException as err:
+            if err.code == ERROR_CODES.unknown_member: # Only Discord knows for sure that they left, their reaction just throws the counts off
+                with suppress(DiscordException):
+                    await self.client.reaction_delete(self.message, rolemoji.emoji, user)
+            raise
+
+    async def run(self, progress=None): # `progress` is an optional coroutine function taking (done, total), returns the counts from `plan`
+        changes, counts = await self.plan()
+        total = len(changes)
+        done = 0
+        failed = 0
+        last_report = monotonic()
+        limits = {} # Route -> semaphore, so a slow route doesn't hold up the others
+        for route, _, _ in changes:
+            if route not in limits:
+                limits[route] = asyncio.Semaphore(self.concurrency)
+
+        async def apply(route, user, rolemoji):
+            nonlocal done, failed, last_report
+            async with limits[route]:
+                try:
+                    await self._apply(route, user, rolemoji)
+                except DiscordException as err:
+                    failed += 1
+                    if route == 'user_role_add' and err.code == ERROR_CODES.unknown_member: # Left, _apply already took their reaction off
+                        counts[rolemoji] -= 1
+                    else:
+                        Logger.error('Roles', f"{route} failed for {user.id}:", repr(err))
+            done += 1
+            if progress is not None and monotonic() - last_report >= self.interval:
+                last_report = monotonic()
+                await progress(done, total)
+
+        await asyncio.gather(*(apply(*change) for change in changes))
+        if progress is not None:
+            await progress(done, total)
+        Logger.info('Roles', f"Reconciled reaction roles, {total} changes ({failed} failed)")
+        return counts
+
+
+class RoleBatcher(object): # Holds on to a member's role changes for a moment, so a burst of reactions becomes one request (or none if they cancel out)
+    def __init__(self, client, guild, delay=2.0):
+        self.client = client
+        self.guild = guild
+        self.delay = delay # Seconds from a member's first change to sending them all
+        self.pending = {} # User ID -> (user, {role: whether they should end up with it}, [reasons])
+
+    def queue(self, user, role, wanted, reason): # Only call from the event loop
+        try:
+            _, changes, reasons = self.pending[user.id]
+        except KeyError: # First change in a while, the timer starts now and doesn't move, so nobody waits longer than `delay`
+            changes = {}
+            reasons = []
+            KOKORO.call_after(self.delay, self._flush, user.id)
+        self.pending[user.id] = (user, changes, reasons)
+        changes[role] = wanted # The last reaction wins
+        reasons.append(reason)
+
+    def _flush(self, user_id):
+        KOKORO.create_task(self._apply(*self.pending.pop(user_id)))
+
+    async def _apply(self, user, changes, reasons):
+        changes = {role: wanted for role, wanted in changes.items() if user.has_role(role) != wanted} # Add-then-remove flip flops drop out here
+        if not changes:
+            return
+        reason = ', '.join(dict.fromkeys(reasons))[:512] # Audit log reasons have a length limit
+        try:
+            if len(changes) == 1: # The single role routes can't clobber a role someone else changed meanwhile
+                role, wanted = changes.popitem()
+                if wanted:
+                    await self.client.user_role_add(user, role, reason=reason)
+                else:
+                    await self.client.user_role_delete(user, role, reason=reason)
+                return
+            profile = user.get_guild_profile_for(self.guild)
+            roles = set(profile.roles or ()) if profile is not None else set()
+            for role, wanted in changes.items():
+                if wanted:
+                    roles.add(role)
+                else:
+                    roles.discard(role)
+            await self.client.user_guild_profile_edit(self.guild, user, roles=roles, reason=reason)
+        except DiscordException as err:
+            if err.code != ERROR_CODES.unknown_member: # They left, nothing to do
+                Logger.error('Roles', f"Couldn't update the roles of {user.id}:", repr(err))
@@ -0,0 +1,81 @@
+from sys import argv
+
+try:
+    import msgpack
+except ImportError: # Binary snapshots are optional, FileDict just sticks to YAML without msgpack
+    msgpack = None
+
+MAGIC = b'HNDS' # Every snapshot starts with this and the version, so old or foreign files are never misread
+VERSION = 1
+
+# msgpack extension type codes
+TUPLE = 1
+OBJECT = 2
+CLASS = 3
+SET = 4
+
+
+class SnapshotCodec(object): # Packs the objects stored in FileDicts (Character, Inventory, SimpleNamespace...) without pickle
+    def __init__(self, classes):
+        self.classes = {cls.__name__: cls for cls in classes} # Only these classes can come out of a snapshot
+
+    def _default(self, obj): # Called by msgpack for anything it can't pack by itself
+        cls = type(obj)
+        if cls is tuple:
+            return msgpack.ExtType(TUPLE, self._pack(list(obj)))
+        if cls in (set, frozenset):
+            return msgpack.ExtType(SET, self._pack(list(obj)))
+        if isinstance(obj, type) and self.classes.get(obj.__name__) is obj: # Inventories store the type of item they accept
+            return msgpack.ExtType(CLASS, obj.__name__.encode())
+        if self.classes.get(cls.__name__) is cls:
+            if hasattr(cls, '__setstate__'):
+                state = obj.__getstate__()
+            else:
+                state = vars(obj)
+            return msgpack.ExtType(OBJECT, self._pack([cls.__name__, state]))
+        raise TypeError(f"Can't snapshot {cls.__name__} objects, register the class first")
+
+    def _ext_hook(self, code, data):
+        if code == TUPLE:
+            return tuple(self._unpack(data))
+        if code == SET:
+            return set(self._unpack(data))
+        if code == CLASS:
+            return self.classes[data.decode()]
+        if code == OBJECT:
+            name, state = self._unpack(data)
+            cls = self.classes[name]
+            obj = cls.__new__(cls) # Skip __init__, the state has everything
+            if hasattr(cls, '__setstate__'):
+                obj.__setstate__(state)
+            else:
+                obj.__dict__.update(state)
+            return obj
+        return msgpack.ExtType(code, data)
+
+    def _pack(self, obj):
+        return msgpack.packb(obj, default=self._default, strict_types=True, use_bin_type=True)
+
+    def _unpack(self, data):
+        return msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False, strict_map_key=False) # User IDs are used as keys
+
+    def dumps(self, data):
+        return MAGIC + bytes((VERSION,)) + self._pack(data)
+
+    def loads(self, blob): # Returns None if the blob isn't a snapshot this version can read
+        if blob[:len(MAGIC)] != MAGIC or blob[len(MAGIC)] != VERSION:
+            return None
+        return self._unpack(blob[len(MAGIC) + 1:])
+
+
+if __name__ == '__main__': # `python -m ext.snapshot characters.yaml items.yaml` writes binary snapshots for existing YAML files
+    from ext.loop import running
+    from ext.utils import FileDict
+
+    with running():
+        if msgpack is None:
+            print("msgpack isn't installed, there's nothing to convert to!")
+        else:
+            for file in argv[1:]:
+                FileDict('{}', file).force_save()
+                print(f"Converted {file}")
@@ -1,26 +1,58 @@
-from collections import UserDict
+from collections import UserDict, Counter, OrderedDict
 from types import SimpleNamespace as SN # Abbreviation for convinience
-from time import sleep
+from time import monotonic
 from math import ceil
-from os import environ
+from os import environ, replace, remove
+from os.path import getmtime
+from threading import Lock
+from contextlib import suppress
+from copy import deepcopy
+from io import StringIO
 from json import loads as jloads
+from hashlib import blake2b
+from zlib import crc32
+from functools import lru_cache
+from random import randint, choices, random
 from re import compile as regcompile, search as regsearch
+import asyncio
 
 import d20
-from ruamel.yaml import YAML
-from httpx import AsyncClient, UnsupportedProtocol
+try:
+    import numpy as np
+except ImportError: # Only used to speed up roll_many, it falls back to the random module if it isn't installed
+    np = None
+from hata import KOKORO
+from scarletio import sleep
+from ruamel.yaml import YAML, YAMLError
 from gspread import SpreadsheetNotFound
-from gspread.utils import fill_gaps, a1_to_rowcol
-from gspread.exceptions import APIError
+from gspread.utils import a1_to_rowcol, extract_id_from_url
+from gspread.exceptions import APIError, NoValidUrlKeyFound
+from requests import RequestException
 import gspread_asyncio as gspread
 from google.oauth2.service_account import Credentials
 from yachalk import chalk
 
+from ext.snapshot import SnapshotCodec, msgpack
+from ext.httpclient import HTTP
+
 yaml = YAML(typ='unsafe')
-yaml.register_class(SN)
-POS_RE = regcompile(r"([A-Z]+)(\d+)")
+YAML_CLASSES = [] # Every class that can be stored in a FileDict, so other YAML instances can be made with the same classes
+
+def new_yaml(): # YAML instances aren't thread safe, so anything dumping outside of the event loop makes its own
+    instance = YAML(typ='unsafe')
+    for cls in YAML_CLASSES:
+        instance.register_class(cls)
+    return instance
+
+def register_class(cls): # Used as a decorator like yaml.register_class
+    YAML_CLASSES.append(cls)
+    return yaml.register_class(cls)
+
+register_class(SN)
+RNG = np.random.default_rng() if np is not None else None
 
-def get_creds():
+@lru_cache(maxsize=None)
+def get_creds(): # Parsed once, google-auth refreshes the token on the same credentials whenever it runs out
     creds = Credentials.from_service_account_info(jloads(environ.get('CREDENTIALS_JSON')))
     scoped = creds.with_scopes([
       "https://spreadsheets.google.com/feeds",
@@ -29,7 +61,84 @@ def get_creds():
     ])
     return scoped
 
-agcm = gspread.AsyncioGspreadClientManager(get_creds)
+SHEETS_LIMIT = asyncio.Semaphore(int(environ.get('SHEETS_CONCURRENCY', 4))) # Shared by every sheet load so the bot as a whole stays under the Sheets quota
+
+
+class SheetsManager(gspread.AsyncioGspreadClientManager): # gspread_asyncio sends one request at a time with gspread_delay between them, this lets SHEETS_LIMIT of them run at once
+    def __init__(self, credentials_fn, limit, retries=5, **kwargs):
+        super().__init__(credentials_fn, **kwargs)
+        self.limit = limit # Semaphore every request holds while it's being sent
+        self.retries = retries # Tries after the first one before the error is raised, gspread_asyncio would retry forever
+
+    async def _call(self, method, *args, **kwargs): # Retries the same things gspread_asyncio does (rate limits, server errors, connection errors), backing off more each time
+        kwargs.pop('api_call_count', None) # Only used for gspread_asyncio's own delays
+        for attempt in range(self.retries + 1):
+            async with self.limit:
+                await self.before_gspread_call(method, args, kwargs)
+                try:
+                    return await asyncio.to_thread(method, *args, **kwargs)
+                except APIError as e:
+                    code = e.response.status_code
+                    if (400 <= code <= 499 and code != 429) or attempt == self.retries: # Our mistake, trying again won't help
+                        raise
+                    error = e
+                except RequestException as e:
+                    if attempt == self.retries:
+                        raise
+                    error = e
+            delay = min(self.gspread_delay * 2 ** attempt, 64) * (0.5 + random()) # Jittered so requests that failed together don't retry together
+            Logger.error('Sheets', f"{method.__name__} failed, retrying in {delay:.1f}s:", repr(error))
+            await asyncio.sleep(delay) # Outside the semaphore so other requests can go meanwhile
+
+
+agcm = SheetsManager(get_creds, SHEETS_LIMIT)
+
+
+class SheetsSession(object): # agcm already keeps the client and every spreadsheet it opened forever, this drops them once they're old or unused
+    def __init__(self, manager, size=64, ttl=3600):
+        self.manager = manager
+        self.size = size # Spreadsheets kept open, least recently used are dropped first
+        self.ttl = ttl # Seconds before a spreadsheet's metadata (worksheets and so on) is fetched again
+        self.client = None # The client `docs` were opened with, agcm swaps it (and its spreadsheets) out when it reauthorises
+        self.docs = OrderedDict() # Spreadsheet ID -> when it was opened
+        self.opened = 0 # Metadata round trips made, and how many were saved
+        self.reused = 0
+
+    def __repr__(self):
+        return f"<SheetsSession open={len(self.docs)} opened={self.opened} reused={self.reused}>"
+
+    async def open(self, url): # Replaces `(await agcm.authorize()).open_by_url(url)`
+        key = extract_id_from_url(url)
+        self.client = client = await self.manager.authorize()
+        opened = self.docs.get(key)
+        if opened is not None and monotonic() - opened >= self.ttl:
+            self._drop(key)
+        fresh = key not in client._ss_cache_key
+        doc = await client.open_by_key(key) # Through agcm._call, so it waits its turn and 429s are retried
+        if fresh:
+            self.opened += 1
+            self.docs[key] = monotonic()
+        else:
+            self.reused += 1
+        self.docs.move_to_end(key)
+        if len(self.docs) > self.size:
+            self._drop(next(iter(self.docs)))
+        return doc
+
+    def forget(self, url): # Call when using a spreadsheet failed, so the next try opens it again
+        with suppress(Exception): # A URL that can't even be parsed was never opened
+            self._drop(extract_id_from_url(url))
+
+    def _drop(self, key):
+        self.docs.pop(key, None)
+        if self.client is None:
+            return
+        doc = self.client._ss_cache_key.pop(key, None)
+        if doc is not None and self.client._ss_cache_title.get(doc.title) is doc:
+            del self.client._ss_cache_title[doc.title]
+
+
+SHEETS = SheetsSession(agcm)
 
 def letter2num(letters, zbase=True):
     """A = 1, C = 3 and so on. Convert spreadsheet style column
@@ -76,55 +185,132 @@ class Logger(object):
         print(f"[{chalk.bg_red.black('ERROR')}] {chalk.green(name)} ⟩ {sep.join(tmp)}")
 
 
-class GSheet(object): # GSheet implementation to easily access values
-    def __init__(self, worksheet):
-        self.worksheet = worksheet
+class SheetCache(object): # Caches anything loaded from Google Sheets, keyed by whatever identifies the load (usually the URL)
+    def __init__(self, ttl=300, stale=3600, size=256):
+        self.ttl = ttl # Seconds a value counts as fresh
+        self.stale = stale # Seconds after that where the old value is still handed out while a reload runs in the background
+        self.size = size # Entries kept, least recently used are dropped first so every sheet ever imported doesn't stay in memory
+        self.entries = OrderedDict() # key -> (value, time it was loaded), least recently used first
+        self.loading = {} # key -> Task, so callers asking for the same key at the same time share one load
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"<SheetCache entries={len(self.entries)} hits={self.hits} stale_hits={self.stale_hits} misses={self.misses} loading={len(self.loading)}>"
+
+    async def get(self, key, loader): # `loader` is a coroutine function returning the value to cache
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, loaded = entry
+            age = monotonic() - loaded
+            if age < self.ttl:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return value
+            if age < self.ttl + self.stale:
+                self.stale_hits += 1
+                self.entries.move_to_end(key)
+                if key not in self.loading:
+                    KOKORO.create_task(self._revalidate(key, loader))
+                return value
+            del self.entries[key] # Too old to hand out at all
+        self.misses += 1
+        return await self._load(key, loader)
+
+    async def refresh(self, key, loader): # Like `get` but never hands out or keeps a cached value, for loads a user asked for. Still shares a load that's already running
+        self.entries.pop(key, None)
+        self.misses += 1
+        return await self._load(key, loader, keep=False)
+
+    def _load(self, key, loader, keep=True): # Starts a load unless one is already running for the key
+        task = self.loading.get(key)
+        if task is None:
+            task = self.loading[key] = KOKORO.create_task(self._run(key, loader, keep))
+        return task
+
+    async def _run(self, key, loader, keep):
+        try:
+            value = await loader()
+            if keep:
+                self.set(key, value)
+            return value
+        finally:
+            del self.loading[key]
+
+    async def _revalidate(self, key, loader): # The stale value is still being used, so a failure here only gets logged
+        try:
+            await self._load(key, loader)
+        except Exception as e:
+            Logger.error('Sheet Cache', f"Couldn't refresh {key!r}:", repr(e))
+
+    def set(self, key, value): # For when something was loaded outside of the cache, like a forced reload
+        self.entries[key] = (value, monotonic())
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
 
-    async def init(self): # Due to it being an async function it can't be called without an await, so make sure it's called once before trying to do anything
-        self.values = await self.worksheet.get_all_values()
-        self.unformatted_values = await self._get_all_unformatted_values()
 
-    async def _get_all_unformatted_values(self): # Grab all of the unformatted values from the sheet
-        data = self.worksheet.ws.spreadsheet.values_get(
-            self.worksheet.title,
-            params={'valueRenderOption': "UNFORMATTED_VALUE"})
-        try:
-            return fill_gaps(data['values'])
-        except KeyError:
-            return []
+SHEET_CACHE = SheetCache(int(environ.get('SHEET_CACHE_TTL', 300)), size=int(environ.get('SHEET_CACHE_SIZE', 256)))
+
+
+class SheetRanges(object): # Easy access to the cells that were fetched with `batch_get`
+    def __init__(self):
+        self.values = {} # (row, col) -> value, rows and cols start at 1 like in a1_to_rowcol
+        self.unformatted_values = {}
+
+    def add(self, value_range, unformatted=False): # Adds one of the valueRanges from a values:batchGet response
+        cells = self.unformatted_values if unformatted else self.values
+        start = value_range['range'].rsplit('!', 1)[-1].split(':')[0]
+        (row_offset, column_offset) = a1_to_rowcol(start)
+        for row, values in enumerate(value_range.get('values', [])): # Trailing empty cells and rows aren't sent at all
+            for col, value in enumerate(values):
+                cells[row_offset + row, column_offset + col] = value
 
     @staticmethod
-    def _get_value(source, pos): # Any function prefixed with _ is not meant to be used by the user using the class, and it's mainly for internal program use
-        _pos = POS_RE.match(pos)
-        if _pos is None:
-            raise ValueError("No A1-style position found.")
-        col = letter2num(_pos.group(1))
-        row = int(_pos.group(2)) - 1
-        if row > len(source) or col > len(source[row]):
-            raise IndexError("Cell out of bounds.")
-        value = source[row][col]
+    def _get_value(source, pos):
+        value = source.get(a1_to_rowcol(pos), '') # Empty cells come out as '' like they do with fill_gaps
         Logger.debug('Cell', f"({pos}) - ({value})")
         return value
 
-    def value(self, pos): # Grab the formatted value from the sheet
+    def value(self, pos):
         return self._get_value(self.values, pos)
 
-    def unformatted_value(self, pos): # Grab the unformatted value from the sheet
+    def unformatted_value(self, pos):
         return self._get_value(self.unformatted_values, pos)
 
+    def rows(self, rng): # Rows of an open ended range like "A2:H", down to the last one that came back
+        start, end = rng.split(':')
+        (first_row, first_column) = a1_to_rowcol(start)
+        last_column = a1_to_rowcol(end + '1')[1]
+        last_row = max((row for row, col in self.values if first_column <= col <= last_column), default=first_row - 1)
+        return [[self.values.get((row, col), '') for col in range(first_column, last_column + 1)] for row in range(first_row, last_row + 1)]
+
     def value_range(self, rng):
-        """Returns a list of values in a range.""" # Triple speech marks indicate a docstring/multiline string
-    #they help users going through the code to understand it, but normal comments like this are also good
+        """Returns a list of values in a range."""
         start, end = rng.split(':')
         (row_offset, column_offset) = a1_to_rowcol(start)
         (last_row, last_column) = a1_to_rowcol(end)
 
         out = []
-        for col in self.values[row_offset - 1:last_row]:
-            out.extend(col[column_offset - 1:last_column])
+        for row in range(row_offset, last_row + 1):
+            for col in range(column_offset, last_column + 1):
+                out.append(self.values.get((row, col), ''))
         return out
 
 
+async def sheet_modified(url): # Drive's last update time of a spreadsheet, a cheap way to tell if anything on it changed
+    doc = await SHEETS.open(url)
+    return await agcm._call(doc.ss.get_lastUpdateTime) # gspread_asyncio doesn't wrap this one, _call still limits and retries it
+
+
+async def batch_get(doc, ranges, unformatted=False): # Fetches a list of (SheetRanges, worksheet title, A1 range) in a single values:batchGet
+    params = {'valueRenderOption': "UNFORMATTED_VALUE"} if unformatted else None
+    data = await doc.values_batch_get([f"'{title}'!{rng}" for _, title, rng in ranges], params=params) # Counts towards SHEETS_LIMIT through agcm
+    for (sheet, _, _), value_range in zip(ranges, data['valueRanges']): # Ranges come back in the order they were asked for
+        sheet.add(value_range, unformatted)
+
+
 class SpreadsheetStats(object): # This just loads the stats for the sheet, in a way that is formatted nice. It isn't needed but makes it nicer to use and write
     def __init__(self, fs, bs, data):
         self.fs = fs # Front sheet
@@ -164,6 +350,11 @@ class SpreadsheetStats(object): # This just loads the stats for the sheet, in a
 
 acmap = {'strength':'str', 'dexterity':'dex', 'constitution':'con', 'intelligence':'int', 'wisdom':'wis', 'charisma':'cha'} # Just maps the values to a dict that it is easily accessed
 
+# Every cell CharSpreadsheet and SpreadsheetStats read, so a sheet can be loaded without downloading whole worksheets
+FRONT_RANGES = ("B1", "B3", "H3", "O3", "T1", "AF3", "U3", "AA3", "P1", "AB1", "AV12", "F9:F14") # Formatted
+DATA_RANGES = ("F2:F7", "B16") # Formatted
+BACK_RANGES = ("AR6", "AR23") # Unformatted
+
 class CharSpreadsheet(object):
     def __init__(self, url, prnsoverride=None, vrbsoverride=None):
         self.url = url           # Google sheet URL
@@ -191,16 +382,26 @@ class CharSpreadsheet(object):
             await self.load()
             setattr(self, 'initialized', True)
 
+    @staticmethod
+    async def fetch(url, prnsoverride=None, vrbsoverride=None): # Always loads the sheet again, someone who just fixed their sheet must never get the old copy back
+        async def loader():
+            sheet = CharSpreadsheet(url, prnsoverride, vrbsoverride)
+            await sheet.init()
+            return sheet
+        return await SHEET_CACHE.refresh(('character', url, prnsoverride, vrbsoverride), loader)
+
     async def load(self):
         try:
-            agc = await agcm.authorize() # Authorise the google key when accessing the sheet, should be made once every time you plan to access the sheet
-            doc = await agc.open_by_url(self.url) # Opens the doc from the sheet
-            self.fs = GSheet(await doc.worksheet('Front'))
-            self.bs = GSheet(await doc.worksheet('Back'))
-            self.data = GSheet(await doc.worksheet('Data'))
-            await self.fs.init()
-            await self.bs.init()
-            await self.data.init()
+            doc = await SHEETS.open(self.url) # Reuses the authorised client and the opened doc if this sheet was loaded before
+            self.fs = SheetRanges()
+            self.bs = SheetRanges()
+            self.data = SheetRanges()
+            # One request per render mode instead of two full downloads of every worksheet, sent at once along with the update time
+            _, _, self.modified = await asyncio.gather(
+              batch_get(doc, [(self.fs, 'Front', rng) for rng in FRONT_RANGES] + [(self.data, 'Data', rng) for rng in DATA_RANGES]),
+              batch_get(doc, [(self.bs, 'Back', rng) for rng in BACK_RANGES], unformatted=True),
+              agcm._call(doc.ss.get_lastUpdateTime), # So CharacterSync can tell later if the sheet changed since
+            )
             self.name = self.fs.value("B1").title()
             self.size = self.fs.value("B3").lower()
             self.hair = self.fs.value("H3").lower()
@@ -232,35 +433,181 @@ class CharSpreadsheet(object):
 
             self.stats = SpreadsheetStats(self.fs, self.bs, self.data)
             await self.stats.init()
-        except (KeyError, SpreadsheetNotFound, APIError):
+        except (KeyError, SpreadsheetNotFound, NoValidUrlKeyFound, APIError):
+            SHEETS.forget(self.url)
             raise InvalidSheetException(f"The sheet URL `{self.url}` is invalid! Make sure you've shared it with me at `hndbot@heroes-and-dragons-bot.iam.gserviceaccount.com` and that you double check it! (If it has /copy or /edit at the end, remove that!)")
 
 
+class AutocompleteIndex(object): # Precomputed lookups for autocomplete, so a keystroke never scans the whole list
+    def __init__(self, names, limit=25, prefix_length=4, candidates=50): # Discord only shows 25 choices
+        self.names = list(names)
+        self.limit = limit
+        self.prefix_length = prefix_length
+        self.candidates = candidates # Names sharing the most letter pairs with a query that get a full typo check, so a fuzzy search costs the same on any list
+        self.folded = [name.casefold() for name in self.names]
+        self.prefixes = {} # Prefix (up to prefix_length characters) -> indexes of the names starting with it
+        self.grams = {} # Trigram -> indexes of the names containing it, used for substring matches
+        self.pairs = {} # Two letters next to each other, in either order -> indexes of the names containing them, used to find fuzzy candidates
+        for i, name in enumerate(self.folded):
+            for n in range(1, min(len(name), prefix_length) + 1):
+                self.prefixes.setdefault(name[:n], []).append(i)
+            for gram in self._grams(name):
+                self.grams.setdefault(gram, set()).add(i)
+            for pair in self._pairs(name):
+                self.pairs.setdefault(pair, set()).add(i)
+
+    @staticmethod
+    def _grams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    @staticmethod
+    def _pairs(text): # Sorted, so a swapped pair of letters ("drgaon") still counts as shared with the right spelling
+        return {a + b if a < b else b + a for a, b in zip(text, text[1:])}
+
+    @staticmethod
+    def _typos(query, name, allowed): # Fewest typos (wrong, missing, extra or swapped letters) for the query to show up anywhere in the name, gives up past `allowed`
+        before = None
+        row = [0] * (len(name) + 1) # Free to start at any point of the name
+        last = ''
+        for i, letter in enumerate(query):
+            current = [i + 1]
+            left = i + 1
+            previous = ''
+            for j, other in enumerate(name):
+                best = row[j] if letter == other else row[j] + 1
+                if row[j + 1] < best:
+                    best = row[j + 1] + 1
+                if left < best:
+                    best = left + 1
+                if letter == previous and last == other and letter != other and before[j - 1] + 1 < best: # "drgaon" is one typo from "dragon", not two
+                    best = before[j - 1] + 1
+                current.append(best)
+                left = best
+                previous = other
+            if min(current) > allowed: # Every way of matching the rest of the query only adds typos
+                return allowed + 1
+            before, row, last = row, current, letter
+        return min(row) # And free to end at any point
+
+    def search(self, value): # Prefix matches first, then substring matches, then fuzzy ones
+        if not value:
+            return self.names[:self.limit]
+        query = value.casefold()
+        found = []
+        seen = set()
+
+        def add(indexes):
+            for i in indexes:
+                if i not in seen:
+                    seen.add(i)
+                    found.append(i)
+                    if len(found) >= self.limit:
+                        return True
+            return False
+
+        prefixed = self.prefixes.get(query[:self.prefix_length], ())
+        if len(query) > self.prefix_length:
+            prefixed = [i for i in prefixed if self.folded[i].startswith(query)]
+        if add(prefixed):
+            return [self.names[i] for i in found]
+
+        grams = self._grams(query)
+        if grams: # Only names containing every trigram of the query can contain the query
+            candidates = set.intersection(*(self.grams.get(gram, set()) for gram in grams))
+        else: # One or two characters, not worth indexing
+            candidates = range(len(self.folded))
+        if add(sorted(i for i in candidates if query in self.folded[i])):
+            return [self.names[i] for i in found]
+
+        allowed = (len(query) - 1) // 3 # One typo from four letters on, two from seven, anything less would match half the list
+        if allowed: # Fuzzy, fewest typos first
+            shared = Counter(i for pair in self._pairs(query) for i in self.pairs.get(pair, ()) if i not in seen)
+            close = []
+            for i, count in shared.most_common(self.candidates):
+                typos = self._typos(query, self.folded[i], allowed)
+                if typos <= allowed:
+                    close.append((typos, -count, i))
+            add(i for _, _, i in sorted(close))
+        return [self.names[i] for i in found]
+
+
+def checksum(values): # Cheap fingerprint of a range, so a reload can tell if anything in it changed
+    return blake2b(repr(values).encode(), digest_size=16).digest()
+
+
+MONSTER_RANGES = ("A2:A322", "B2:B322") # Names and descriptions on the MonsterDex sheet
+DM_RANGES = ("D2:D8",) # DM user IDs on the Settings sheet
+
 class DMSheet(object):
-    def __init__(self, url): # Might as well make it easy to change if the DM sheet has a new URL
+    def __init__(self, url, refresh=300): # Might as well make it easy to change if the DM sheet has a new URL
         self.url = url
+        self.refresh = refresh # Seconds between background checks for changes
+        self.modified = None # Drive's modifiedTime of the sheet when it was last loaded, if it's the same nothing needs downloading
+        self.checksums = {} # Sheet name -> checksum of the ranges read from it, unchanged sheets aren't processed again
+        self.monsters = {}
+        self.MONSTER_LIST = []
+        self.monster_index = AutocompleteIndex(self.MONSTER_LIST)
+        self.DMUIDs = []
+        self.refresher = None
+
+    async def init(self): # Cheap to call all the time, the sheet is only reloaded once the cached copy gets old
+        await SHEET_CACHE.get(('dm', self.url), self._load)
+
+    async def _load(self):
+        await self.reload()
+        return self
+
+    async def reload(self, force=False): # Returns True if anything was changed, `force` skips the modified time check
+        modified = await sheet_modified(self.url)
+        if modified == self.modified and not force:
+            Logger.debug('DM Sheet', f"Unchanged since {modified}")
+            SHEET_CACHE.set(('dm', self.url), self)
+            return False
+
+        md = SheetRanges() # MonsterDex sheet, allows the DM to easily add and remove monsters so they can be looked up via the bot
+        st = SheetRanges() # Settings sheet
+        await batch_get(await SHEETS.open(self.url), [(md, 'MonsterDex', rng) for rng in MONSTER_RANGES] + [(st, 'Settings', rng) for rng in DM_RANGES]) # Only the cells that are used, in one request
+        rows = [(name.title(), desc) for name, desc in zip(*(md.value_range(rng) for rng in MONSTER_RANGES)) if name] # Skip empty rows
+        ids = st.value_range(DM_RANGES[0])
+        dmuids = [int(id) for id in ids if id] # Parsed before anything is stored, so a bad ID leaves the old state and the next reload tries again
+        self.md, self.st, self.modified = md, st, modified
+
+        changed = False
+        if self._changed('MonsterDex', rows):
+            self._set_monsters(rows)
+            changed = True
+        if self._changed('Settings', ids):
+            self.DMUIDs = dmuids
+            changed = True
+        SHEET_CACHE.set(('dm', self.url), self) # Any successful reload counts as fresh, including forced and background ones
+        return changed
+
+    def _changed(self, sheet, values): # Stores the new checksum and returns whether it's different from the last one
+        new = checksum(values)
+        if self.checksums.get(sheet) == new:
+            return False
+        self.checksums[sheet] = new
+        return True
 
-    async def init(self):
-        try: # Initialise sheet if it isn't already loaded
-            getattr(self, 'initialized')
-        except AttributeError:
-            await self.reload()
-            setattr(self, 'initialized', True)
-
-    async def reload(self):
-        agc = await agcm.authorize() # Authorise with the Google API before accessing
-        doc = await agc.open_by_url(self.url)
-        self.fs = GSheet(await doc.worksheet('General DM Sheet'))
-        self.md = GSheet(await doc.worksheet('MonsterDex')) # MonsterDex sheet, allows the DM to easily add and remove monsters so they can be looked up via the bot
-        self.st = GSheet(await doc.worksheet('Settings')) # Settings sheet
-        await self.fs.init()
-        await self.md.init()
-        await self.st.init()
-        MONSTERS = self.md.value_range("A2:A322")
-        self.MONSTER_LIST = [MONSTER.title() for MONSTER in MONSTERS]
-        self.monsters = dict(zip(self.MONSTER_LIST, self.md.value_range("B2:B322"))) # Zip the values together into an easy to lookup dict
-
-        self.DMUIDs = [int(id) for id in self.st.value_range("sD2:D8")]
+    def _set_monsters(self, rows): # Only called when the MonsterDex checksum changed
+        self.monsters = dict(rows) # Later rows win for duplicate names, so the dict and the list always agree on which names exist
+        self.MONSTER_LIST = [name for name, _ in rows]
+        self.monster_index = AutocompleteIndex(self.MONSTER_LIST)
+        Logger.debug('DM Sheet', f"Reloaded {len(rows)} MonsterDex rows")
+
+    def start_refresh(self): # Keeps the sheet up to date in the background, a check is a single small request when nothing changed
+        if self.refresher is None or self.refresher.is_done():
+            self.refresher = KOKORO.create_task(self._refresh())
+
+    async def _refresh(self):
+        while True:
+            await sleep(self.refresh, KOKORO)
+            try:
+                if await self.reload():
+                    Logger.info('DM Sheet', "Picked up changes from the DM sheet")
+            except Exception as e: # Anything, including connection errors, is tried again next time instead of killing the task
+                SHEETS.forget(self.url)
+                Logger.error('DM Sheet', "Background reload failed:", repr(e))
 
     def is_dm(self, id):
         if id in self.DMUIDs:
@@ -268,15 +615,58 @@ class DMSheet(object):
         return False
 
 
-dmsheet = DMSheet(environ['DM_SHEET'])
+dmsheet = DMSheet(environ['DM_SHEET'], int(environ.get('DM_SHEET_REFRESH', 300)))
 
-def roll(u, dice, mod): # Rolls the dice, u is the character the dice is rolling on, dice is the dice in the format `1d6` or `3d20`
+SIMPLE_DICE_RE = regcompile(r"(\d*)d(\d+)(?:([+-])(\d+))?") # NdM+K, the only kind of roll that skips d20
+MAX_DICE = d20.RollContext().max_rolls # The most dice d20 rolls at once, the fast path has to stop at the same place
+MAX_SIDES = 2 ** 31 # Anything bigger goes through d20, numpy's integers can't go much further
+
+def normalise_dice(dice): # So `1D6 + 2` and `1d6+2` share a cache entry
+    return ''.join(dice.lower().split())
+
+@lru_cache(maxsize=1024)
+def compile_dice(dice): # Expects normalised dice, returns (count, sides, bonus) for plain NdM+K rolls and a parsed d20 AST for anything else
+    match = SIMPLE_DICE_RE.fullmatch(dice)
+    if match:
+        count = int(match.group(1) or 1)
+        sides = int(match.group(2))
+        bonus = int(match.group(4) or 0)
+        if match.group(3) == '-':
+            bonus = -bonus
+        if count > MAX_DICE: # Same error d20.roll gives, instead of rolling a billion dice on the event loop
+            raise d20.TooManyRolls("Too many dice rolled.")
+        if count and 0 < sides <= MAX_SIDES:
+            return (count, sides, bonus)
+    return d20.parse(dice) # Raises d20's errors for invalid dice, same as d20.roll did
+
+def get_mod(u, mod): # Turns a modifier name into the character's modifier value
     if isinstance(mod, str): # Check if the modifier is a string, if so, use acmap to look up the modifier value
         try:
-            mod = getattr(u.stats.base, acmap.get(mod.lower())+'_mod')
+            mod = getattr(u.stats.mods, acmap.get(mod.lower()))
         except (AttributeError, TypeError):
             mod = False   # You can perform operations on booleans, False is equal to 0 in Python
-    return (d20.roll(dice).total, mod) # Returns a python tuple (like a list that can't have new values added or existing ones deleted)
+    return mod
+
+def roll(u, dice, mod): # Rolls the dice, u is the character the dice is rolling on, dice is the dice in the format `1d6` or `3d20`
+    compiled = compile_dice(normalise_dice(dice))
+    if isinstance(compiled, tuple):
+        count, sides, bonus = compiled
+        total = sum(randint(1, sides) for _ in range(count)) + bonus
+    else:
+        total = d20.roll(compiled).total
+    return (total, get_mod(u, mod)) # Returns a python tuple (like a list that can't have new values added or existing ones deleted)
+
+def roll_many(u, dice, mod, times): # Same as roll but rolls the dice `times` times, returns a list of totals and the modifier
+    compiled = compile_dice(normalise_dice(dice))
+    if not isinstance(compiled, tuple): # Anything fancier than NdM+K has to go through d20 one roll at a time
+        totals = [d20.roll(compiled).total for _ in range(times)]
+    elif np is not None: # Every die of every roll in one go
+        count, sides, bonus = compiled
+        totals = (RNG.integers(1, sides + 1, size=(times, count)).sum(axis=1) + bonus).tolist()
+    else:
+        count, sides, bonus = compiled
+        totals = [sum(choices(range(1, sides + 1), k=count)) + bonus for _ in range(times)]
+    return (totals, get_mod(u, mod))
 
 
 class ClashingPropertyError(Exception): # Define a few exceptions to be raised
@@ -291,7 +681,7 @@ class InventoryFullError(Exception):
     pass
 
 
-@yaml.register_class
+@register_class
 class ItemProperties(object): # The properties an item has
     def __init__(self, dice=None, damage=False, heal=False, non_self=False, on_self=False):
         if damage and heal:
@@ -303,13 +693,14 @@ class ItemProperties(object): # The properties an item has
         self.os = on_self
 
 
-@yaml.register_class
+@register_class
 class Item(object):
-    def __init__(self, name, weight=1, props=None, amount=1): # Weight is weight per object, in lbs
+    def __init__(self, name, weight=1, props=None, amount=1, rarity=None): # Weight is weight per object, in lbs
         self.name = name
         self.weight = weight # Weight just means encumberance
         self.props = props # Make it props so it's quicker to type
         self.amount = amount
+        self.rarity = rarity # One of RARITIES, or None for mundane things. Items saved before this don't have it at all
 
     def use(self, user, dice, target=None, mod=0):
         if not target:
@@ -330,19 +721,23 @@ class Item(object):
 
     @property
     def total_weight(self):
-        return self.weight * amount
+        return self.weight * self.amount
 
+    @property
+    def total_value(self): # Only precious materials are worth anything for now
+        return 0
 
-@yaml.register_class
+
+@register_class
 class Arrow(Item):
-    def __init___(self, name, weight=0.05): # Arrow weighs 0.05 lbs on it's own
+    def __init__(self, name, weight=0.05, amount=1): # Arrow weighs 0.05 lbs on it's own
         self.name = name
         self.weight = weight
         self.props = ItemProperties("1d4-4", True, False, True, False)
-        self.amount = 1
+        self.amount = amount
 
 
-@yaml.register_class
+@register_class
 class PreciousMaterial(Item):
     def __init__(self, name, weight=0, value=1000): # A type of item specifically for gems, etc
         self.name = name
@@ -351,32 +746,106 @@ class PreciousMaterial(Item):
         self.props = ItemProperties("0", False, False, False, False)
         self.amount = 1
 
+    @property
+    def total_value(self):
+        return self.value * self.amount
+
 
-@yaml.register_class
+@register_class
 class Inventory(object):
+    __slots__ = ('limiter', 'weight', 'type', 'inv', 'items_weight', 'items_value') # Every character has several, slots keep them small
+    SAVED = ('limiter', 'weight', 'type', 'inv') # The totals are worked out again on load
+
     def __init__(self, limiter, weight=0, type=Item):
         self.limiter = limiter # Value for how many items can be in the inventory
         self.weight = weight # Some inventories have a weight themselves
         self.type = type # The type of items the inventory accepts
         self.inv = [] # A list of items to just store it
+        self.items_weight = 0 # Running totals of everything in `inv`, kept up to date by add/remove so nothing has to walk the items
+        self.items_value = 0
+
+    def __getstate__(self): # Slotted objects have no __dict__, so YAML and the snapshots need this to save them
+        return {slot: getattr(self, slot) for slot in self.SAVED}
+
+    def __setstate__(self, state):
+        for key in self.SAVED:
+            setattr(self, key, state[key])
+        self.recount()
 
     @property
     def inv_e(self):
-        result = self.weight
-        for item in self.inv:
-            result += item.total_weight
-        return result
+        return self.weight + self.items_weight
+
+    @property
+    def value(self):
+        return self.items_value
+
+    def recount(self): # Call after changing an item that's already in here (its amount, say)
+        self.items_weight = sum(item.total_weight for item in self.inv)
+        self.items_value = sum(item.total_value for item in self.inv)
 
     def add(self, item):
         if self.limiter != 0 and len(self.inv) + 1 > self.limiter:
             raise InventoryFullError("Inventory is full! Can't hold anymore items! Clear up your bag or maybe use a different inventory?")
         self.inv.append(item)
+        self.items_weight += item.total_weight
+        self.items_value += item.total_value
         return len(self.inv)
 
+    def pop(self, index=-1):
+        item = self.inv.pop(index)
+        self.items_weight -= item.total_weight
+        self.items_value -= item.total_value
+        return item
+
+    def remove(self, item):
+        return self.pop(self.inv.index(item))
+
+
+class LazyInventory(object): # Descriptor for Character, the inventory is only made the first time something uses it
+    def __init__(self, *args):
+        self.args = args # Passed to Inventory
+        self.weight = args[1] if len(args) > 1 else 0 # What it weighs before it's made
+
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.slot = '_' + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError: # Slots raise this until they're set
+            inventory = Inventory(*self.args)
+            setattr(obj, self.slot, inventory)
+            return inventory
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
 
-@yaml.register_class
+DEFAULT_IMAGE = "https://cdn.discordapp.com/attachments/902668029115138081/917889852962402365/Untitled121_20211207212621.jpg" # For characters whose sheet image is missing or broken
+
+@register_class
 class Character(object):
-    def __init__(self, name, race, eyes, hair, age, gender, verbs, pronouns, height, weight, level, fpm, image, yen, base, mods):
+    __slots__ = ( # Every character is in memory all the time, slots keep them small
+      'name', 'race', 'eyes', 'hair', 'age', 'gender', 'verbs', 'pronouns', 'height', 'weight', 'level', 'image', 'yen',
+      'stats', 'fpm', 'bpa', 'boha', 'sheet_url', 'prnsoverride', 'vrbsoverride', 'modified', 'size',
+      '_body_inv', '_belt_pouch', '_quiver', '_backpack', '_bag_of_holding', '_gems', '_valuables',
+    )
+
+    # Inventory stuff, most characters never touch most of these so they're made on first use
+    body_inv = LazyInventory(9)
+    belt_pouch = LazyInventory(12, 1)
+    quiver = LazyInventory(6, 1, Arrow)
+    backpack = LazyInventory(6, 5)
+    bag_of_holding = LazyInventory(0, 15)
+    gems = LazyInventory(6, 0, PreciousMaterial)
+    valuables = LazyInventory(7, 0, PreciousMaterial)
+    INVENTORIES = ('body_inv', 'belt_pouch', 'quiver', 'backpack', 'bag_of_holding', 'gems', 'valuables')
+
+    def __init__(self, name, race, eyes, hair, age, gender, verbs, pronouns, height, weight, level, fpm, image, yen, base, mods, size='medium'):
         # Player desc stuff
         self.name = name
         self.race = race
@@ -391,38 +860,45 @@ class Character(object):
         self.level = level
         self.image = image
         self.yen = yen
+        self.size = size # As written on the sheet, like 'medium'
 
         # Player stats
         self.stats = SN(base=base, mods=mods)
         self.fpm = fpm
 
-        # Inventory stuff
-        self.body_inv = Inventory(9)
-        self.belt_pouch = Inventory(12, 1)
-        self.quiver = Inventory(6, 1, Arrow)
-        self.backpack = Inventory(6, 5)
-        self.bag_of_holding = Inventory(0, 15)
         self.bpa = False # Player doesn't have a backpack either
         self.boha = False # Player doesn't have bag of holding yet so don't give them access to it
-        self.gems = Inventory(6, type=PreciousMaterials)
-        self.valuables = Inventory(7, type=PreciousMaterials)
+
+        # Where the character came from so CharacterSync can pull it again, characters saved before this don't have these
+        self.sheet_url = None
+        self.prnsoverride = None
+        self.vrbsoverride = None
+        self.modified = None # The sheet's last update time when it was imported, if it hasn't moved the sheet doesn't need downloading
+
+    def __getstate__(self): # Empty inventories aren't saved, they come back by themselves. Older saves with every inventory still load
+        state = {}
+        for slot in self.__slots__:
+            if slot[0] != '_' and hasattr(self, slot):
+                state[slot] = getattr(self, slot)
+        for name in self.INVENTORIES:
+            inventory = getattr(self, '_' + name, None)
+            if inventory is not None and inventory.inv:
+                state[name] = inventory
+        return state
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
 
     @staticmethod # Not a class method and should only be called externally
     async def import_from_url(url, prns, vrbs): # Asynchronous so it can use asynchronous functions
-        sheet = CharSpreadsheet(url, prns, vrbs)
-        await sheet.init() # Initialise sheet
-        print(sheet.image)
+        sheet = await CharSpreadsheet.fetch(url, prns, vrbs) # Loads and initialises the sheet, sharing the load if the same sheet is already being imported
 
         image_url = sheet.image
-        try:
-            async with AsyncClient() as client:
-                r = await client.get(sheet.image)
-            if r.status_code != 200:
-                image_url = "https://cdn.discordapp.com/attachments/902668029115138081/917889852962402365/Untitled121_20211207212621.jpg"
-        except (UnsupportedProtocol, TypeError):
-            image_url = "https://cdn.discordapp.com/attachments/902668029115138081/917889852962402365/Untitled121_20211207212621.jpg"
-
-        return Character(
+        if not await HTTP.url_ok(sheet.image): # A HEAD on the shared client, and cached, so re-syncs don't check the same image again
+            image_url = DEFAULT_IMAGE
+
+        char = Character(
           sheet.name,
           sheet.race,
           sheet.eyes,
@@ -453,7 +929,21 @@ class Character(object):
             wis=sheet.stats.wis_mod,
             cha=sheet.stats.cha_mod
           ),
+          sheet.size,
         )
+        char.sheet_url = url
+        char.prnsoverride = prns
+        char.vrbsoverride = vrbs
+        char.modified = sheet.modified
+        return char
+
+    def keep_inventory(self, old): # For a re-synced character, brings over everything the bot tracks that isn't on the sheet
+        for name in self.INVENTORIES:
+            inventory = getattr(old, '_' + name, None)
+            if inventory is not None:
+                setattr(self, name, inventory)
+        self.bpa = old.bpa
+        self.boha = old.boha
 
     @property
     def spm(self): # Squares per move
@@ -470,44 +960,56 @@ class Character(object):
             f"and {self.eyes} eyes."
         )
 
+    def _inv_e(self, name, contents=True): # Weight of an inventory, without making it if it was never used
+        inventory = getattr(self, '_' + name, None)
+        if inventory is None:
+            return getattr(type(self), name).weight # Empty, so only the inventory itself weighs anything
+        return inventory.inv_e if contents else inventory.weight
+
+    # All of these just add up the inventories' running totals, so they're cheap enough to check on every action
     @property
     def inv_total_e(self):
-        result = self.body_inv.inv_e() + self.belt_pouch.inv_e() + self.quiver.inv_e()
-        result += self.belt_pouch.weight + self.quiver.weight
+        result = self._inv_e('body_inv') + self._inv_e('belt_pouch') + self._inv_e('quiver') + self._inv_e('gems') + self._inv_e('valuables')
         if self.bpa:
-            result += self.backpack.weight
+            result += self._inv_e('backpack')
         if self.boha:
-            result += self.bag_of_holding.weight # Bag of Holding always weighs 15 lbs
+            result += self._inv_e('bag_of_holding', contents=False) # Bag of Holding always weighs 15 lbs, whatever's in it
         return result
 
+    @property
+    def size_multiplier(self): # Carrying capacity multiplier, characters saved before sizes were kept count as medium
+        return getattr(Size, getattr(self, 'size', 'medium'), 1)
+
     @property
     def _get_light_e(self):
-        return (self.stat.str * 5) * self.size # Returns light encumbrance value in lbs
+        return (self.stats.base.str * 5) * self.size_multiplier # Returns light encumbrance value in lbs
 
     @property
     def _get_heavy_e(self):
-        return (self.stat.str * 10) * self.size
+        return (self.stats.base.str * 10) * self.size_multiplier
 
     @property
     def _get_max_e(self):
-        return (self.stat.str * 15) * self.size
+        return (self.stats.base.str * 15) * self.size_multiplier
 
     @property
     def wealth(self):
         result = self.yen
-        for i in gems:
-            result += i.value
-        for i in valuables:
-            result += i.value
+        for name in ('gems', 'valuables'):
+            inventory = getattr(self, '_' + name, None)
+            if inventory is not None:
+                result += inventory.value
         return result
 
     @property
     def encumbered_calc(self): # Calculates if the player is encumbered
-        if self._get_max_e() >= self.inv_total_e():
+        total = self.inv_total_e # Worked out once instead of for every threshold
+        strength = self.stats.base.str * self.size_multiplier
+        if total > strength * 15:
             return "M" # Return strings as they're easier to check
-        elif self._get_heavy_e() >= self.inv_total_e():
+        elif total > strength * 10:
             return "H"
-        elif self._get_light_e() >= self.inv_total_e():
+        elif total > strength * 5:
             return "L"
         return "N"
 
@@ -520,11 +1022,165 @@ RARITIES = ( # Valid item rarities for DM to make new items
   "Artifact"
 )
 
+ITEM_KINDS = { # Keys of the items FileDict, and the class of the items each one holds
+  'items': Item,
+  'arrows': Arrow,
+  'valuables': PreciousMaterial,
+}
+ITEM_RANGE = "A2:H" # Name, type, weight, value, rarity, dice, effect and targets columns on the DM sheet's Items tab, down to the last row that has anything in it
+SHEET_ITEM_KINDS = {'item': 'items', 'arrow': 'arrows', 'valuable': 'valuables'} # What the type column says -> ITEM_KINDS key
+
+
+class ItemCatalog(object): # Indexes over the items FileDict, so lookups and duplicate checks don't walk the lists. Add items through this or the indexes go stale
+    def __init__(self, store):
+        self.store = store
+        self.names = {kind: {} for kind in ITEM_KINDS} # Kind -> casefolded name -> item, names only have to be unique within a kind like before
+        self.rarities = {} # Rarity -> casefolded name -> item
+        for kind in ITEM_KINDS:
+            for item in store.get(kind, ()):
+                self._index(kind, item)
+
+    def _index(self, kind, item):
+        key = item.name.casefold()
+        self.names[kind][key] = item
+        rarity = getattr(item, 'rarity', None)
+        if rarity:
+            self.rarities.setdefault(rarity, {})[key] = item
+
+    def get(self, name, kind=None): # Looks through every kind unless one is given
+        key = name.casefold()
+        for k in ((kind,) if kind else ITEM_KINDS):
+            item = self.names[k].get(key)
+            if item is not None:
+                return item
+        return None
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def of_kind(self, kind):
+        return list(self.names[kind].values())
+
+    def of_rarity(self, rarity):
+        return list(self.rarities.get(rarity, {}).values())
+
+    def _insert(self, kind, item): # Returns False for duplicates, the caller touches the list
+        if item.name.casefold() in self.names[kind]:
+            return False
+        rarity = getattr(item, 'rarity', None)
+        if rarity is not None and rarity not in RARITIES:
+            raise ValueError(f"`{rarity}` isn't a rarity! Use one of {', '.join(RARITIES)}")
+        self.store.data.setdefault(kind, []).append(item)
+        self._index(kind, item)
+        return True
+
+    def add(self, kind, item): # Returns False if there's already an item of that kind with the name
+        if not self._insert(kind, item):
+            return False
+        self.store.touch(kind)
+        return True
+
+    def add_many(self, entries): # (kind, item) pairs, each list that changed is only written once. Returns (added, duplicates)
+        added = 0
+        touched = set()
+        for kind, item in entries:
+            if self._insert(kind, item):
+                added += 1
+                touched.add(kind)
+        for kind in touched:
+            self.store.touch(kind)
+        return added, len(entries) - added
+
+    @staticmethod
+    def item_from_row(name, kind, weight, value, rarity, dice, effect, targets): # One row of the Items tab, raises ValueError if it doesn't make sense
+        kind = SHEET_ITEM_KINDS.get(str(kind).strip().lower() or 'item')
+        if kind is None:
+            raise ValueError(f"type has to be one of {', '.join(SHEET_ITEM_KINDS)}")
+        if kind == 'valuables':
+            return kind, PreciousMaterial(name, 0, float(value or 1000))
+        if kind == 'arrows':
+            return kind, Arrow(name, float(weight or 0.05))
+        effect = str(effect).strip().lower()
+        targets = str(targets).strip().lower()
+        rarity = str(rarity).strip().title() or None
+        if rarity is not None and rarity not in RARITIES:
+            raise ValueError(f"`{rarity}` isn't a rarity")
+        props = None
+        if dice: # Items without dice are just for RP
+            props = ItemProperties(dice, effect == 'damage', effect == 'heal', targets in ('others', 'both'), targets in ('self', 'both'))
+        return kind, Item(name, float(weight or 1), props, rarity=rarity)
+
+    async def import_sheet(self, url, tab='Items'): # Adds every item on a sheet tab in one write, returns (added, duplicates, errors)
+        doc = await SHEETS.open(url)
+        sheet = SheetRanges()
+        try:
+            await batch_get(doc, [(sheet, tab, ITEM_RANGE)])
+        except APIError as e:
+            if e.response.status_code != 400: # 400 is what a tab that doesn't exist gets
+                raise
+            raise InvalidSheetException(f"Couldn't read the `{tab}` tab of the DM sheet! Make sure it exists and is spelled the same.")
+        entries = []
+        errors = []
+        for row in sheet.rows(ITEM_RANGE):
+            if not row[0]: # Skip empty rows
+                continue
+            try:
+                kind, item = self.item_from_row(*row)
+            except (ValueError, ClashingPropertyError) as e:
+                errors.append(f"{row[0]}: {e}")
+                continue
+            entries.append((kind, item))
+        added, duplicates = self.add_many(entries)
+        return added, duplicates, errors
+
+SNAPSHOT = SnapshotCodec(YAML_CLASSES) # Binary snapshots can hold the same classes as the YAML ones
+
+def replay_journal(raw, data, loader): # Applies the records in the bytes of a journal to `data`, returns (records applied, corrupt records skipped, where the last whole record ends)
+    count = 0
+    bad = 0
+    end = 0 # Anything after this is a torn write, or one still being written when someone else is reading the journal
+    while end < len(raw):
+        newline = raw.find(b'\n', end)
+        try:
+            length, crc = raw[end:newline].split(b' ') if newline != -1 else ()
+            length, crc = int(length), int(crc, 16)
+        except ValueError: # The header itself got cut off (or mangled), there's no telling where the next record starts
+            break
+        payload = raw[newline + 1:newline + 1 + length]
+        if len(payload) < length:
+            break
+        end = newline + 1 + length
+        record = None
+        if crc32(payload) == crc:
+            with suppress(YAMLError, UnicodeDecodeError):
+                record = loader.load(payload.decode())
+        if not isinstance(record, dict) or record.get('op') not in ('set', 'del') or 'key' not in record or (record['op'] == 'set' and 'value' not in record):
+            bad += 1 # Its length was intact, so only this record is lost and the ones after it still count
+            continue
+        if record['op'] == 'set':
+            data[record['key']] = record['value']
+        else:
+            data.pop(record['key'], None)
+        count += 1
+    return count, bad, end
+
+
 class FileDict(UserDict): # Subclassing UserDict (an implementation of a normal python dictionary that was *made* to be subclassed) so it can automatically load and save from files
-    def __init__(self, init, file, *args, **kwargs):
+    def __init__(self, init, file, *args, compact_after=256, delay=1.0, publish=False, **kwargs):
         super().__init__(*args, **kwargs) # Initialise the superclass (UserDict) so everything is initialised
-        self.lock = False
-        self.file = file
+        self.lock = Lock() # Guards `pending`, keys get marked on the event loop while the writer runs in an executor thread
+        self.io_lock = Lock() # Only one write touches the files at a time
+        self.file = file # Snapshot of the whole dict, only rewritten when the journal is compacted
+        self.binary = file + '.bin' if msgpack else None # Same snapshot in a binary format, written next to the YAML and way faster to load
+        self.journal = file + '.journal' # Every change to a key gets appended here, so a write costs the same no matter how big the dict is
+        self.compact_after = compact_after # How many journal records can pile up before they're folded into the snapshot
+        self.delay = delay # Seconds to wait for more changes before writing, so a burst of changes becomes one write
+        self.publish = publish and bool(self.binary) # Keep the binary snapshot current for other processes, they replay the journal on top of it (see SnapshotReader)
+        self.pending = {} # Keys changed since the last write, mapped to 'set' or 'del'
+        self.batches = [] # Lists of (key, op, copied value) taken on the event loop, waiting for the writer thread
+        self._catalog = None
+        self.scheduled = False
+        self.handle = None
 
         # Ensures the file exists
         try:
@@ -534,76 +1190,295 @@ class FileDict(UserDict): # Subclassing UserDict (an implementation of a normal
             with open(self.file, 'w+') as f:
                 f.write(init)
 
-        with open(self.file) as f: # Open the yaml file to load the data into the dict
-            tmp = yaml.load(f)
-            if tmp:
-                self.data.update(tmp) # `data` points to the actual dict that is implemented in the UserDict code. Update just adds all values from characters.yaml into the current dict
-        self.counter = 0
+        tmp = self._load_binary()
+        stale = tmp is None # No binary snapshot, or one from before the YAML was edited
+        if stale:
+            with open(self.file) as f: # Open the yaml file to load the data into the dict
+                tmp = yaml.load(f)
+        if tmp:
+            self.data.update(tmp) # `data` points to the actual dict that is implemented in the UserDict code. Update just adds all values from characters.yaml into the current dict
+
+        self.records = self._replay(self.journal, repair=True)
+        if self.records:
+            Logger.debug('FileDict', f"Replayed {self.records} journal records for {self.file}")
+        if self.publish and stale: # Readers load the binary snapshot, after that only compactions rewrite it
+            self._write_binary(self.data)
+
+    def _load_binary(self): # Returns None when there's no usable binary snapshot, so the YAML gets loaded instead
+        if not self.binary:
+            return None
+        try:
+            if getmtime(self.binary) < getmtime(self.file): # The YAML was changed by hand after the binary was written
+                return None
+            with open(self.binary, 'rb') as f:
+                return SNAPSHOT.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            Logger.error('FileDict', f"Couldn't load {self.binary}, falling back to YAML:", repr(e))
+            return None
+
+    def _replay(self, journal, data=None, loader=yaml, repair=False): # Applies every record in a journal file on top of a loaded snapshot (the live dict by default)
+        if data is None:
+            data = self.data
+        try:
+            with open(journal, 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return 0
+        if raw.startswith(b'---'): # Written before records had a length and checksum
+            return self._replay_unframed(journal, raw, data, loader, repair)
+
+        count, bad, end = replay_journal(raw, data, loader)
+        if bad:
+            Logger.error('FileDict', f"Skipped {bad} corrupt records in {journal}")
+        if end < len(raw):
+            Logger.error('FileDict', f"Dropped a torn record at the end of {journal}, {count} records replayed")
+            if repair: # So the next append doesn't land after the garbage
+                with open(journal, 'r+b') as f:
+                    f.truncate(end)
+        return count
+
+    def _replay_unframed(self, journal, raw, data, loader, repair):
+        count = 0
+        try:
+            for record in loader.load_all(raw.decode()):
+                if record['op'] == 'set':
+                    data[record['key']] = record['value']
+                else:
+                    data.pop(record['key'], None)
+                count += 1
+        except (YAMLError, KeyError, TypeError) as e: # Torn at the end, the records before it are still good
+            Logger.error('FileDict', f"Stopped replaying {journal} after {count} records:", repr(e))
+        if repair: # Folded into the snapshot straight away, so new framed records never get appended after these
+            self._write_snapshot(data)
+            remove(journal)
+            return 0
+        return count
+
+    def _mark(self, key, op): # Queues a key to be written, the first change in a burst schedules the write
+        with self.lock:
+            self.pending[key] = op
+            if self.scheduled:
+                return
+            self.scheduled = True
+        KOKORO.call_soon_thread_safe(self._schedule)
+
+    def _schedule(self): # Runs on the event loop
+        self.handle = KOKORO.call_after(self.delay, self._start_write)
+
+    def _take(self): # Runs on the event loop, copies every pending value so the writer thread never sees one halfway through a change
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.scheduled = False
+        records = []
+        for key, op in pending.items():
+            if op == 'set':
+                try:
+                    records.append((key, op, deepcopy(self.data[key]))) # Always the latest value, so five changes to a key are one record
+                except KeyError: # Deleted after it was queued, the delete is pending again already
+                    continue
+            else:
+                records.append((key, op, None))
+        if records:
+            with self.lock:
+                self.batches.append(records) # In the order they were taken, the writer drains them in the same order
+        return bool(records)
+
+    def _start_write(self):
+        self.handle = None
+        if self._take():
+            KOKORO.run_in_executor(self._write)
+
+    def _write(self): # Runs in an executor thread, appends every batch taken so far to the journal in one go
+        with self.io_lock:
+            with self.lock:
+                batches, self.batches = self.batches, []
+            records = [record for batch in batches for record in batch]
+            if not records:
+                return
+
+            try:
+                dumper = new_yaml()
+                frames = []
+                for key, op, value in records:
+                    record = {'op': op, 'key': key}
+                    if op == 'set':
+                        record['value'] = value
+                    buffer = StringIO()
+                    dumper.dump(record, buffer)
+                    payload = buffer.getvalue().encode()
+                    frames.append(b'%d %08x\n' % (len(payload), crc32(payload)) + payload) # Length and checksum, so replay can tell a whole record from a torn one
+                with open(self.journal, 'ab') as f:
+                    start = f.tell()
+                    try:
+                        f.write(b''.join(frames))
+                        f.flush()
+                    except Exception: # Don't leave half a batch in front of the retry
+                        with suppress(OSError):
+                            f.truncate(start)
+                        raise
+            except Exception as e:
+                Logger.error('FileDict', f"Failed to write {len(records)} keys to {self.journal}, retrying:", repr(e))
+                with self.lock: # Put them back without clobbering anything newer, the retry copies the values again
+                    for key, op, _ in records:
+                        self.pending.setdefault(key, op)
+                    if not self.scheduled:
+                        self.scheduled = True
+                        KOKORO.call_soon_thread_safe(self._schedule)
+                return
+
+            self.records += len(records)
+            if self.records >= self.compact_after:
+                try:
+                    self._compact()
+                except Exception as e: # The journal is left alone so nothing is lost, the next write tries again
+                    Logger.error('FileDict', f"Failed to compact the journal of {self.file}:", repr(e))
+
+    def _saved(self): # What's on disk, snapshot plus journal, loaded into a fresh dict. Only touches files so it's safe off the event loop
+        data = self._load_binary()
+        if data is None:
+            with open(self.file) as f:
+                data = new_yaml().load(f) or {}
+        self._replay(self.journal, data, new_yaml())
+        return data
+
+    def _compact(self): # Folds the journal into a fresh snapshot, only called while holding io_lock
+        self._write_snapshot(self._saved()) # Never the live dict, the event loop could be changing it
+        with suppress(FileNotFoundError):
+            remove(self.journal)
+        self.records = 0
+        Logger.debug('FileDict', f"Compacted the journal of {self.file}")
+
+    def _write_snapshot(self, data): # Writes to a temporary file first so a crash never leaves a half written snapshot
+        with open(self.file + '.tmp', 'w') as f:
+            new_yaml().dump(data, f)
+        replace(self.file + '.tmp', self.file)
+        if self.binary: # Written after the YAML so it's never older than it
+            self._write_binary(data)
+
+    def _write_binary(self, data): # Loading it replays the journal on top, which is harmless when it already has those changes
+        with open(self.binary + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT.dumps(data))
+        replace(self.binary + '.tmp', self.binary)
 
     def __setitem__(self, key, value):
-        self.counter += 1 # Incremented every time data is written to the dict
         super().__setitem__(key, value) # Call UserDict's setitem function
-        if self.counter >= 5: # If counter is 5 then save all data
-            while self.lock:
-                pass
-            self.lock = True
-            with open(self.file, 'w+') as f:
-                yaml.dump(self.data, f)
-            self.counter = 0
-            self.lock = False
-
-    def force_save(self): # So it can easily be saved on demand
-        while self.lock:
-            pass
-        self.lock = True
-        with open(self.file, 'w+') as f:
-            yaml.dump(self.data, f)
-        self.counter = 0
-        self.lock = False
+        self._mark(key, 'set')
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._mark(key, 'del')
+
+    def touch(self, key): # Queues the current value of a key, call this after mutating a value in place (like appending to a list in it)
+        self._mark(key, 'set')
+
+    async def flush(self): # Writes everything that's still waiting on the delay, await this before shutting down
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self._take()
+        await KOKORO.run_in_executor(self._write)
+
+    def force_save(self): # Writes a full snapshot of the live dict right now, this blocks so only call it while nothing else is changing the dict
+        with self.io_lock:
+            with self.lock:
+                self.pending.clear() # The snapshot has the latest value of everything
+                self.batches.clear()
+            self._write_snapshot(self.data)
+            with suppress(FileNotFoundError):
+                remove(self.journal)
+            self.records = 0
 
     async def new_character(self, url, acc, prnsoverride=None, vrbsoverride=None): # Creates the character and adds it to the dict, only call this on characters.yaml
         if self.get(acc):
             return False # Returns False if the account already has a character sheet linked to it
-        self[acc] = await Character.import_from_url(url, prnsoverride, vrbsoverride)
-        self.force_save() # So it isn't deleted after a restart call force save
+        self[acc] = await Character.import_from_url(url, prnsoverride, vrbsoverride) # Setting the key journals it, so it survives a restart
         return True # Return True to indicate success
 
-    def new_item(self, name, weight=0.05, dice=False, damage=False, health=False, non_self=False, on_self=False):
-        try:
-            self.data['items']
-        except KeyError:
-            self.data['items'] = []
-        for i in self.data['items']:
-            if name.title() == i.name.title():
-                return False # Return False if item is already in the list
+    @property
+    def catalog(self): # Only for items.yaml, built the first time it's needed
+        if self._catalog is None:
+            self._catalog = ItemCatalog(self)
+        return self._catalog
+
+    def new_item(self, name, weight=0.05, dice=False, damage=False, health=False, non_self=False, on_self=False, rarity=None):
         props = ItemProperties(dice, damage, health, non_self, on_self)
-        self.data['items'].append(Item(name, weight, props))
-        self.force_save()
-        return True
+        return self.catalog.add('items', Item(name, weight, props, rarity=rarity)) # Return False if item is already in the list
 
     def new_arrow(self, name, weight=0.5):
-        try:
-            self.data['arrows']
-        except KeyError:
-            self.data['arrows'] = []
-        for i in self.data['arrows']:
-            if name.title() == i.name.title():
-                return False # Return False if item is already in the list
-        self.data['arrows'].append(Arrow(name, weight))
-        self.force_save()
-        return True
+        return self.catalog.add('arrows', Arrow(name, weight))
 
     def new_valuable(self, name, value=1000): # Value in Yem
-        try:
-            self.data['valuables']
-        except KeyError:
-            self.data['valuables'] = []
-        for i in self.data['valuables']:
-            if name.title() == i.name.title():
-                return False # Return False if item is already in the list
-        self.data['valuables'].append(PreciousMaterial(name, 0, value))
-        self.force_save()
+        return self.catalog.add('valuables', PreciousMaterial(name, 0, value))
+
+
+class CharacterSync(object): # Pulls linked characters from their sheets again in the background, so level ups show up without relinking
+    def __init__(self, chars, interval=3600, concurrency=4):
+        self.chars = chars
+        self.interval = interval # Seconds between passes over every character
+        self.concurrency = concurrency # Sheets worked on at once, SHEETS_LIMIT still caps the requests themselves
+        self.task = None
+
+    async def sync(self, user_id, force=False): # Returns True if the character changed, `force` skips the update time check
+        char = self.chars.get(user_id)
+        url = getattr(char, 'sheet_url', None)
+        if url is None: # Linked before sheets were remembered, they'll have to relink once
+            return False
+        modified = await sheet_modified(url)
+        if modified == char.modified and not force:
+            return False
+        new = await Character.import_from_url(url, char.prnsoverride, char.vrbsoverride)
+        if self.chars.get(user_id) is not char: # Unlinked or relinked while the sheet was loading
+            return False
+        new.keep_inventory(char)
+        self.chars[user_id] = new
         return True
 
-
-
+    async def _each(self, work, keys, progress=None): # Runs `work(key)` for every key, a few at a time. Returns (changed, unchanged, {key: error})
+        limit = asyncio.Semaphore(self.concurrency)
+        changed = 0
+        failed = {}
+        done = 0
+
+        async def run(key):
+            nonlocal changed, done
+            async with limit:
+                try:
+                    if await work(key):
+                        changed += 1
+                except Exception as e: # Bad URLs, broken sheets and connection errors alike, one sheet can't stop the rest or the report
+                    failed[key] = e
+            done += 1
+            if progress is not None:
+                await progress(done, len(keys))
+
+        await asyncio.gather(*(run(key) for key in keys))
+        return changed, len(keys) - changed - len(failed), failed
+
+    async def sync_all(self, progress=None): # `progress` is an optional coroutine function taking (done, total)
+        changed, unchanged, failed = await self._each(self.sync, list(self.chars.keys()), progress)
+        for user_id, e in failed.items():
+            Logger.error('Sync', f"Couldn't sync the character of {user_id}:", repr(e))
+        Logger.info('Sync', f"Synced characters, {changed} changed, {unchanged} unchanged, {len(failed)} failed")
+        return changed, unchanged, failed
+
+    async def import_many(self, links, progress=None): # `links` maps user IDs to sheet URLs, existing characters are left alone
+        return await self._each(lambda user_id: self.chars.new_character(links[user_id], user_id), list(links), progress)
+
+    def start(self):
+        if self.task is None or self.task.is_done():
+            self.task = KOKORO.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            await sleep(self.interval, KOKORO)
+            try:
+                await self.sync_all()
+            except Exception as e: # Tried again next time instead of stopping background syncs for good
+                Logger.error('Sync', "Background sync failed:", repr(e))
@@ -0,0 +1,462 @@
+from os import walk
+from os.path import join, relpath, getmtime
+from hashlib import sha256
+from gzip import compress as gzip_compress
+from mimetypes import guess_type
+from io import StringIO
+from collections import OrderedDict
+from hmac import new as hmac_new, compare_digest
+from secrets import token_urlsafe
+from time import time, monotonic
+from typing import Optional
+
+import lesscpy
+from hata import Oauth2Access, USERS, DiscordException
+from fastapi import Request, Cookie
+from starlette.responses import Response, HTMLResponse, RedirectResponse
+
+try:
+    import brotli
+except ImportError: # Brotli is optional, gzip is always there
+    brotli = None
+
+from ext.utils import Logger, SNAPSHOT, new_yaml, replay_journal
+
+MEDIA_TYPES = { # Things mimetypes gets wrong or doesn't know about
+  '.js': 'text/javascript',
+  '.css': 'text/css',
+  '.less': 'text/css', # Served compiled
+  '.ico': 'image/x-icon',
+}
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+
+class Asset(object): # A single file, kept in memory along with its compressed versions
+    __slots__ = ('body', 'gzip', 'brotli', 'etag', 'media_type', 'source', 'mtime')
+
+    def __init__(self, body, media_type, source, mtime):
+        self.body = body
+        self.media_type = media_type
+        self.source = source # File on disk it was built from, so it can be rebuilt when it changes
+        self.mtime = mtime
+        self.etag = '"' + sha256(body).hexdigest()[:16] + '"' # Content hash, so it only changes when the file does
+        self.gzip = None
+        self.brotli = None
+        if media_type.startswith(COMPRESSIBLE):
+            compressed = gzip_compress(body, 9)
+            if len(compressed) < len(body): # Tiny files can come out bigger
+                self.gzip = compressed
+            if brotli:
+                compressed = brotli.compress(body)
+                if len(compressed) < len(body):
+                    self.brotli = compressed
+
+
+class StaticAssets(object): # Serves everything under a directory from memory with ETags, compression and long caching
+    def __init__(self, directory, watch=False, max_age=31536000):
+        self.directory = directory
+        self.watch = watch # Check files for changes on every request, only worth it while developing
+        self.max_age = max_age # Only for URLs from url(), their content hash changes whenever the file does
+        self.assets = {} # URL path (relative to the directory) -> Asset
+        self.load()
+
+    def load(self): # (Re)builds every asset, LESS files get compiled to CSS here instead of in every browser
+        assets = {}
+        for root, _, files in walk(self.directory):
+            for name in files:
+                if name.startswith('.'): # .gitkeep and friends
+                    continue
+                source = join(root, name)
+                path = relpath(source, self.directory).replace('\\', '/')
+                for key, asset in self._build(path, source):
+                    assets[key] = asset
+        self.assets = assets
+        Logger.debug('Static', f"Loaded {len(assets)} assets from {self.directory}")
+
+    def _build(self, path, source): # Yields (path, Asset) pairs for a file
+        mtime = getmtime(source)
+        with open(source, 'rb') as f:
+            body = f.read()
+        if path.endswith('.less'):
+            css = Asset(lesscpy.compile(StringIO(body.decode()), minify=True).encode(), 'text/css', source, mtime)
+            yield path, css # Old links to the .less file get the compiled CSS too
+            yield path[:-len('.less')] + '.css', css
+            return
+        extension = '.' + path.rsplit('.', 1)[-1] if '.' in path else ''
+        media_type = MEDIA_TYPES.get(extension) or guess_type(path)[0] or 'application/octet-stream'
+        yield path, Asset(body, media_type, source, mtime)
+
+    def _refresh(self, path): # Rebuilds an asset if its file changed since it was loaded
+        asset = self.assets.get(path)
+        try:
+            if asset is None or getmtime(asset.source) == asset.mtime:
+                return asset
+            for key, rebuilt in self._build(relpath(asset.source, self.directory).replace('\\', '/'), asset.source):
+                self.assets[key] = rebuilt
+        except FileNotFoundError:
+            self.load()
+        return self.assets.get(path)
+
+    def url(self, path): # For templates, the hash in the query changes whenever the file does so browsers can cache forever
+        asset = self.assets.get(path)
+        if asset is None:
+            return '/static/' + path
+        return f"/static/{path}?v={asset.etag[1:-1]}"
+
+    def response(self, path, headers, version=None): # `headers` are the request headers, `version` is the `v` the URL was asked for with
+        asset = self._refresh(path) if self.watch else self.assets.get(path)
+        if asset is None:
+            return Response(status_code=404)
+
+        if version == asset.etag[1:-1]: # A URL from url(), a new version of the file gets a new URL
+            cache_control = f"public, max-age={self.max_age}, immutable"
+        else: # Plain or outdated URLs would stay stale after a deploy, so browsers check the ETag every time
+            cache_control = "no-cache"
+        response_headers = {
+          'ETag': asset.etag,
+          'Cache-Control': cache_control,
+          'Vary': 'Accept-Encoding',
+        }
+        if asset.etag in headers.get('if-none-match', ''):
+            return Response(status_code=304, headers=response_headers)
+
+        body = asset.body
+        accepted = headers.get('accept-encoding', '')
+        if asset.brotli and 'br' in accepted:
+            body = asset.brotli
+            response_headers['Content-Encoding'] = 'br'
+        elif asset.gzip and 'gzip' in accepted:
+            body = asset.gzip
+            response_headers['Content-Encoding'] = 'gzip'
+        return Response(content=body, media_type=asset.media_type, headers=response_headers)
+
+
+class PageRenderer(object): # Renders the dashboard templates without TemplateResponse looking them up and building a context every request
+    def __init__(self, templates, static=(), size=256):
+        self.env = templates.env
+        self.static_names = static # Templates with no variables, rendered once and kept as bytes
+        self.size = size # How many rendered pages `cached` keeps
+        self.cache = OrderedDict() # (template, key) -> bytes, oldest first
+        self.load()
+
+    def load(self): # Compiles every template up front, call again if the templates change
+        self.templates = {name: self.env.get_template(name) for name in self.env.list_templates()}
+        self.static = {name: self.templates[name].render().encode() for name in self.static_names}
+        self.cache.clear()
+
+    def page(self, template, **context): # Returns the page as bytes
+        try:
+            return self.static[template]
+        except KeyError:
+            return self.templates[template].render(**context).encode()
+
+    def cached(self, template, key, **context): # Like page, but reuses the render for the same key, `key` has to cover everything in `context`
+        cache_key = (template, key)
+        try:
+            self.cache.move_to_end(cache_key)
+            return self.cache[cache_key]
+        except KeyError:
+            pass
+        body = self.cache[cache_key] = self.page(template, **context)
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return body
+
+
+class Session(object): # A logged in dashboard user
+    __slots__ = ('user_id', 'access', 'expires')
+
+    def __init__(self, user_id, access, expires):
+        self.user_id = user_id
+        self.access = access # Oauth2Access, its refresh token lets the session be renewed without sending the user through Discord again
+        self.expires = expires # Unix time, the same as when the access token runs out
+
+    @property
+    def expired(self):
+        return time() >= self.expires
+
+    def to_data(self): # For persisting in a FileDict
+        return {'user_id': self.user_id, 'expires': self.expires, 'access': self.access.to_data(), 'redirect_url': self.access.redirect_url}
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(data['user_id'], Oauth2Access.from_data(data['access'], data['redirect_url']), data['expires'])
+
+
+class SessionStore(object): # Server side sessions, the cookie only holds a random session ID and its signature
+    def __init__(self, secret, size=1024, persist=None, lifetime=30*24*3600):
+        self.secret = secret.encode()
+        self.size = size # Sessions kept in memory, older ones are only looked up in `persist`
+        self.sessions = OrderedDict() # Session ID -> Session, least recently used first
+        self.persist = persist # Optional FileDict so sessions survive restarts
+        self.lifetime = lifetime # Seconds the cookie lasts, and how long after its access token runs out a session can still be renewed
+        self.purge()
+
+    def _sign(self, sid):
+        return hmac_new(self.secret, sid.encode(), 'sha256').hexdigest()
+
+    def _unsign(self, cookie): # Returns the session ID if the cookie wasn't tampered with
+        if not cookie:
+            return None
+        sid, _, signature = cookie.partition('.')
+        if compare_digest(signature.encode(), self._sign(sid).encode()): # As bytes, comparing str raises for anything that isn't ASCII
+            return sid
+        return None
+
+    def _dead(self, session): # Too long since the access token ran out, the cookie is gone by now anyway
+        return time() >= session.expires + self.lifetime
+
+    def purge(self): # Forgets every dead session, so `persist` doesn't grow forever
+        for sid in [sid for sid, session in self.sessions.items() if self._dead(session)]:
+            del self.sessions[sid]
+        if self.persist is not None:
+            for sid in [sid for sid, data in self.persist.items() if time() >= data['expires'] + self.lifetime]:
+                del self.persist[sid]
+
+    def _remember(self, sid, session):
+        self.sessions[sid] = session
+        self.sessions.move_to_end(sid)
+        if len(self.sessions) > self.size:
+            self.sessions.popitem(last=False)
+
+    def create(self, user_id, access): # Returns the value to put in the cookie
+        self.purge() # Logins are rare enough for this to be the place
+        sid = token_urlsafe(24)
+        session = Session(user_id, access, time() + access.expires_after)
+        self._remember(sid, session)
+        if self.persist is not None:
+            self.persist[sid] = session.to_data()
+        return f"{sid}.{self._sign(sid)}"
+
+    def lookup(self, cookie): # Returns the session even if it expired, so its refresh token can be used
+        sid = self._unsign(cookie)
+        if sid is None:
+            return None
+        session = self.sessions.get(sid)
+        if session is None and self.persist is not None:
+            data = self.persist.get(sid)
+            if data is None:
+                return None
+            session = Session.from_data(data)
+        if session is None:
+            return None
+        if self._dead(session):
+            self.delete(cookie)
+            return None
+        self._remember(sid, session)
+        return session
+
+    def get(self, cookie): # Returns the session if it's valid, this is all a page load needs
+        session = self.lookup(cookie)
+        if session is None or session.expired:
+            return None
+        return session
+
+    def refresh(self, cookie): # Call after renewing the session's access token, moves its expiry to match
+        sid = self._unsign(cookie)
+        session = self.lookup(cookie)
+        if session is None:
+            return
+        session.expires = time() + session.access.expires_after
+        if self.persist is not None:
+            self.persist[sid] = session.to_data()
+
+    def delete(self, cookie):
+        sid = self._unsign(cookie)
+        if sid is None:
+            return
+        self.sessions.pop(sid, None)
+        if self.persist is not None and sid in self.persist:
+            del self.persist[sid]
+
+
+class SnapshotReader(object): # Read only copy of a FileDict, for processes other than the bot. Every worker loads the binary snapshot and follows the journal itself
+    def __init__(self, file, interval=1.0):
+        self.binary = file + '.bin'
+        self.journal = file + '.journal'
+        self.interval = interval # Seconds between checks for changes
+        self.loader = new_yaml()
+        self.data = {}
+        self.mtime = None # Of the binary snapshot, it only changes when the bot folds the journal into it
+        self.head = None # First line of the journal that's being followed, a new journal starts with a different one
+        self.offset = 0 # Where the records read so far end
+        self.checked = 0
+
+    def _refresh(self):
+        now = monotonic()
+        if now - self.checked < self.interval:
+            return
+        self.checked = now
+        try:
+            if getmtime(self.binary) != self.mtime and not self._load():
+                return
+            with open(self.journal, 'rb') as f:
+                head = f.readline()
+                if self.head is not None and head != self.head: # Compacted and started over since the last look
+                    if not self._load():
+                        return
+                f.seek(self.offset)
+                raw = f.read()
+        except FileNotFoundError: # No journal, nothing changed since the snapshot. Unless one was being followed, then the snapshot has it all now
+            if self.head is not None:
+                self._load()
+            return
+        if head.endswith(b'\n'):
+            self.head = head
+        self.offset += replay_journal(raw, self.data, self.loader)[2] # A record that's still being written gets picked up next time
+
+    def _load(self): # Starts over from the binary snapshot, returns False if there isn't a usable one
+        try:
+            mtime = getmtime(self.binary)
+            with open(self.binary, 'rb') as f:
+                data = SNAPSHOT.loads(f.read())
+        except (FileNotFoundError, ValueError): # Not written yet, or empty
+            return False
+        if data is None:
+            return False
+        self.data = data
+        self.mtime = mtime
+        self.head = None
+        self.offset = 0
+        return True
+
+    def get(self, key, default=None):
+        self._refresh()
+        return self.data.get(key, default)
+
+
+BACKEND_ACTIONS = ('session', 'renew', 'login', 'logout', 'github_update') # What web workers can ask the bot to do over the bridge
+
+
+class LocalBackend(object): # What the dashboard needs from the bot, used directly when the web server runs in the bot process
+    def __init__(self, client, sessions, chars, root, on_update):
+        self.client = client
+        self.sessions = sessions
+        self.chars = chars
+        self.root = root
+        self.on_update = on_update # Coroutine function that posts the GitHub update message
+
+    # Everything returned from here has to be plain JSON, it's sent to workers as is
+    async def session(self, cookie): # Returns None if there's no such session
+        user = self.sessions.lookup(cookie)
+        if user is None:
+            return None
+        return {'user_id': user.user_id, 'expired': user.expired, 'name': await self.name(user.user_id)}
+
+    async def name(self, user_id): # Sessions outlive the USERS cache across restarts, so missing users are fetched once
+        user = USERS.get(user_id)
+        if user is None:
+            try:
+                user = await self.client.user_get(user_id)
+            except DiscordException:
+                return "Unknown"
+        return user.full_name
+
+    async def renew(self, cookie): # Uses the refresh token instead of sending them through Discord's OAuth page again, returns whether it worked
+        user = self.sessions.lookup(cookie)
+        if user is None:
+            return False
+        try:
+            await self.client.renew_access_token(user.access)
+        except DiscordException as err:
+            Logger.debug('Session renewal failed', user.user_id, '|', err)
+            return False
+        self.sessions.refresh(cookie)
+        Logger.debug('Renewed Session', user.user_id)
+        return True
+
+    async def login(self, code):
+        oauth_access = await self.client.activate_authorization_code(self.root+'/callback', code, 'identify')
+        user = await self.client.user_info_get(oauth_access)
+        Logger.debug('Authorised User', user.id, '|', user.name)
+        return {'cookie': self.sessions.create(user.id, oauth_access), 'max_age': self.sessions.lifetime} # Outlives the access token, so /authorise can renew it
+
+    async def logout(self, cookie):
+        self.sessions.delete(cookie)
+
+    async def github_update(self):
+        await self.on_update()
+
+    def character(self, user_id): # Not one of the actions, workers read characters from the snapshot themselves
+        return self.chars.get(user_id)
+
+
+class BridgeBackend(object): # The same interface as LocalBackend for web workers, Discord things go over the bridge to the bot
+    def __init__(self, bridge, chars):
+        self.bridge = bridge # BridgeClient
+        self.chars = chars # SnapshotReader of characters.yaml
+
+    async def session(self, cookie):
+        if not cookie: # Saves a round trip for logged out visitors
+            return None
+        return await self.bridge.call('session', cookie=cookie)
+
+    async def renew(self, cookie):
+        return await self.bridge.call('renew', cookie=cookie)
+
+    async def login(self, code):
+        return await self.bridge.call('login', code=code)
+
+    async def logout(self, cookie):
+        await self.bridge.call('logout', cookie=cookie)
+
+    async def github_update(self):
+        await self.bridge.call('github_update')
+
+    def character(self, user_id):
+        return self.chars.get(user_id)
+
+
+def add_routes(app, backend, assets, pages, root, oauth_url): # The dashboard, the same in the bot process and in web workers
+    with open('favicon.ico', 'rb') as f:
+        favicon_response = Response(content=f.read(), media_type='image/x-icon', status_code=200)
+
+    @app.get('/')
+    async def home(req:Request, session:Optional[str]=Cookie(None)):
+        user = await backend.session(session) # No OAuth requests on a page load
+        if not user or user['expired']:
+            response = RedirectResponse(url=root+'/authorise')
+            response.set_cookie(key='redir', value='/', expires=360)
+            return response
+        char = backend.character(user['user_id'])
+        character = char.name if char else None
+        return HTMLResponse(pages.cached("index.html", (user['user_id'], user['name'], character), name=user['name'], character=character)) # Everything shown is part of the key so changes show up
+
+    @app.get('/static/{path:path}', include_in_schema=False)
+    async def static(path:str, req:Request):
+        return assets.response(path, req.headers, req.query_params.get('v'))
+
+    @app.get('/favicon.ico', include_in_schema=False)
+    async def favicon():
+        return favicon_response
+
+    @app.get('/authorise')
+    async def authorise(redir:Optional[str]=Cookie('/'), session:Optional[str]=Cookie(None)):
+        user = await backend.session(session)
+        if user and (not user['expired'] or await backend.renew(session)):
+            return RedirectResponse(url=redir)
+        return RedirectResponse(url=oauth_url)
+
+    @app.get('/callback')
+    async def authorised(redir:Optional[str]=Cookie('/'), code:str=None):
+        Logger.debug('OAuth code', code)
+        if not code:
+            return HTMLResponse(f"""<h1>Invalid Access Code!</h1>
+                <p>To login, go to <a href={root}/authorise>the OAuth page</>!</p>""")
+        login = await backend.login(code)
+        response = RedirectResponse(url=redir)
+        response.set_cookie(key='session', value=login['cookie'], max_age=login['max_age'], httponly=True, samesite='lax')
+        return response
+
+    @app.get('/logout')
+    async def logout(req:Request, session:Optional[str]=Cookie(None)):
+        if session:
+            await backend.logout(session)
+        response = HTMLResponse(pages.page("logout.html")) # Fully static, rendered once at startup
+        response.delete_cookie(key="session")
+        return response
+
+    @app.post('/github', include_in_schema=False)
+    async def update():
+        await backend.github_update()
+        return {}
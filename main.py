@@ -1,14 +1,18 @@
 from os import environ
+from signal import signal, SIGINT, SIGTERM
 
-from hata import Client, Guild
+from hata import Client, Guild, KOKORO
 from scarletio.ext import asyncio
 from hata.ext.commands_v2 import checks
 from hata.ext.extension_loader import EXTENSION_LOADER
-from uvicorn import run as run_server
+from uvicorn import Config, Server
 from fastapi import FastAPI
 from fastapi.templating import Jinja2Templates
 
 from ext.utils import FileDict
+from ext.httpclient import HTTP
+from ext.web import SessionStore
+from ext.reactions import ReactionRouter
 from ext.interpreter import Interpreter
 
 client = Client(environ['TOKEN'], secret=environ['SECRET'], client_id=int(environ['CLIENT_ID']), prefix=environ.get('PREFIX', 'h>'), extensions=('slash', 'commands_v2'))
@@ -22,9 +26,17 @@ async def launch(client):
     global MESSAGE
     MESSAGE = await client.message_get(913148168756162590, 925140179516272660)
 
-chars = FileDict('{}', 'characters.yaml')
+chars = FileDict('{}', 'characters.yaml', publish=bool(environ.get('BRIDGE_SOCKET'))) # Web workers read characters from its binary snapshot and journal
 items = FileDict('[]', 'items.yaml')
 misc = FileDict("{'info':{}}", 'miscellaneous.yaml')
+sessions = SessionStore( # Dashboard logins, only kept on disk if PERSIST_SESSIONS is set
+  environ.get('SESSION_SECRET', environ['SECRET']),
+  persist=FileDict('{}', 'sessions.yaml') if environ.get('PERSIST_SESSIONS') else None,
+)
+
+reactions = ReactionRouter() # Minihatas add routes to it instead of handling reaction events themselves
+client.events(reactions.reaction_add, name='reaction_add')
+client.events(reactions.reaction_delete, name='reaction_delete')
 
 PORT = 8080
 app = FastAPI()
@@ -39,6 +51,8 @@ EXTENSION_LOADER.add_default_variables(
   chars=chars,
   items=items,
   misc=misc,
+  sessions=sessions,
+  reactions=reactions,
   app=app,
   templates=templates,
 )
@@ -51,6 +65,27 @@ client.commands(Interpreter(globals()), name='execute', checks=[checks.owner_onl
 # Start the client
 client.start()
 
-# Start uvicorn (Now supported by Hata!)
+# uvicorn runs as a task on KOKORO next to the gateway, so web handlers call hata directly instead of across loops
+server = None
+server_task = None
 if environ.get('WEB'):
-    run_server(app, host="0.0.0.0", port=PORT, log_level="info")
+    server = Server(Config(app, host="0.0.0.0", port=PORT, log_level="info"))
+    server_task = KOKORO.create_task_thread_safe(server.serve())
+
+async def shutdown(): # Stops the web server, writes out every FileDict, then disconnects
+    if server is not None:
+        server.should_exit = True # Lets in-flight requests finish
+        await server_task
+    for store in (chars, items, misc, sessions.persist):
+        if store is not None:
+            await store.flush()
+    await HTTP.aclose()
+    await client.disconnect()
+    KOKORO.stop()
+
+def on_signal(signum, frame):
+    KOKORO.create_task_thread_safe(shutdown())
+
+signal(SIGINT, on_signal)
+signal(SIGTERM, on_signal)
+KOKORO.join() # Keeps the main thread around so it can receive the signals
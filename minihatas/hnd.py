@@ -1,8 +1,11 @@
 from datetime import datetime
+from os import environ
+from re import compile as regcompile
+from time import monotonic
 
-from hata import User, Embed
+from hata import User, Embed, KOKORO
 
-from ext.utils import dmsheet, InvalidSheetException, roll
+from ext.utils import dmsheet, InvalidSheetException, roll, roll_many, AutocompleteIndex, CharacterSync
 
 # Initialise variables
 BASE_STATS = ( # Autocomplete values
@@ -19,10 +22,27 @@ ROLLABLE_STATS = [
   *BASE_STATS,
 ]
 
+MAX_ROLLS = 100 # Most rolls /roll_dice will do in one go, so the message fits
+
+BASE_STATS_INDEX = AutocompleteIndex(BASE_STATS)
+ROLLABLE_STATS_INDEX = AutocompleteIndex(ROLLABLE_STATS)
+
+LINK_RE = regcompile(r"<?@?!?(\d{15,21})>?\s+(https://\S+)") # A user (mention or ID) followed by their sheet URL, for /import_sheets
+
+char_sync = CharacterSync(chars, int(environ.get('CHARACTER_SYNC', 3600))) # Seconds between pulling every linked sheet again
+
+def teardown(lib): # Called by the extension loader before a reload, the reloaded module starts its own
+    char_sync.stop()
+
+if client.running: # Reloaded while connected, `ready` doesn't come again until the gateway reconnects
+    KOKORO.call_soon_thread_safe(char_sync.start)
+
 
 # Events handler
 @client.events
 async def ready(client):
+    dmsheet.start_refresh() # Picks up DM sheet edits without anyone running reload_dm_sheet, started first so it still runs if the load below fails
+    char_sync.start()
     await dmsheet.init()
     print(f"`{client:f}` is ready.")
 
@@ -38,9 +58,34 @@ async def import_sheet(event, sheet_url:str, prnsoverride:str=None, vrbsoverride
             return
         yield "You already have a character linked to your account!"
         return
-    except InvalidSheetException as e:
-        del data[event.user.id]
-        yield e
+    except InvalidSheetException as e: # Nothing was stored, the error is raised before the character is
+        yield str(e)
+
+
+@client.interactions(guild=guilds)
+async def import_sheets(event, links:('str', 'Each person and their sheet, like `@user https://docs.google.com/...`')):
+    """Imports character sheets for a bunch of people at once"""
+    if not dmsheet.is_dm(event.user.id):
+        yield "You're not a DM and don't have access to this command!"
+        return
+    pairs = {int(id): url for id, url in LINK_RE.findall(links)}
+    if not pairs:
+        yield "Couldn't find any `@user sheet_url` pairs!"
+        return
+    yield f"Importing {len(pairs)} sheets..."
+
+    last = 0
+    async def progress(done, total): # At most one edit every couple of seconds
+        nonlocal last
+        if done == total or monotonic() - last >= 2:
+            last = monotonic()
+            await client.interaction_response_message_edit(event, f"Importing sheets... {done}/{total}")
+
+    added, skipped, failed = await char_sync.import_many(pairs, progress)
+    result = f"Imported {added} characters, {skipped} people already had one linked!"
+    if failed:
+        result += "\nThese failed:\n" + '\n'.join(f"`{id}`: {e}" for id, e in list(failed.items())[:20]) # Keeps the message under Discord's limit
+    yield result
 
 
 @client.interactions(guild=guilds)
@@ -68,7 +113,7 @@ async def overview(event, user:('user', 'View another user\'s character sheet!')
 
 
 @client.interactions(guild=guilds)
-async def roll_dice(event, dice:('str', 'Use a format like `1d6` to roll 1 6-sided die'), stat:('str', 'Choose a value from the list!')="Undefined", mod:('str', 'Add a base to the stat')=0):
+async def roll_dice(event, dice:('str', 'Use a format like `1d6` to roll 1 6-sided die'), stat:('str', 'Choose a value from the list!')="Undefined", mod:('str', 'Add a base to the stat')=0, count:('int', 'Roll the dice this many times at once, like for initiative')=1):
     """Roll dice!"""
     char = chars.get(event.user.id)
     if not char:
@@ -76,13 +121,24 @@ async def roll_dice(event, dice:('str', 'Use a format like `1d6` to roll 1 6-sid
         return
     dice = dice.lower()
     stat = stat.title()
-    res = roll(char, dice, mod)
+    count = max(1, min(count, MAX_ROLLS))
+    if count > 1:
+        res = roll_many(char, dice, mod, count)
+    else:
+        res = roll(char, dice, mod)
     if stat not in ROLLABLE_STATS:
         yield f"{stat} isn't in the rollable stats, defaulting to `Undefined`! Rollable stats are: `{', '.join(ROLLABLE_STATS)}`"
         stat = "Undefined"
     if mod not in BASE_STATS:
         yield f"{mod} isn't a valid modifier, defaulting to `Undefined`! Valid modifiers are: `{', '.join(BASE_STATS)}`"
         mod = "Undefined"
+    if count > 1:
+        totals = ', '.join(str(total + res[1]) for total in res[0])
+        if stat != "Undefined":
+            yield f"Rolled a {dice} {count} times for {stat}, with a modifier of {res[1] or 0} for {mod}: {totals}!"
+            return
+        yield f"Rolled a {dice} {count} times, with a modifier of {res[1] or 0}: {totals}!"
+        return
     if res[1] and stat != "Undefined":
         yield f"Rolled a {dice} which has a value of {res[0]} for {stat}, with a modifier of {res[1]} for {mod}, for a total of {res[0]+res[1]}!"
     elif not res[1] and stat != "Undefined":
@@ -112,8 +168,10 @@ async def reload_dm_sheet(event):
         yield "You're not a DM and don't have access to this command!"
         return
     yield "Reloading DM sheet..."
-    await dmsheet.reload()
-    yield "DM sheet reloaded!"
+    if await dmsheet.reload(force=True):
+        yield "DM sheet reloaded!"
+        return
+    yield "DM sheet reloaded, nothing changed!"
 
 
 @client.interactions(guild=guilds)
@@ -125,21 +183,33 @@ async def add_item(event, name:('str', 'Name of the item you wanna add')):
     yield "Not implemented yet!"
 
 
+@client.interactions(guild=guilds)
+async def import_items(event, tab:('str', 'Tab of the DM sheet the items are on')="Items"):
+    """Adds every item on a tab of the DM sheet to the campaign at once"""
+    if not dmsheet.is_dm(event.user.id):
+        yield "You're not a DM and don't have access to this command!"
+        return
+    yield "Importing items..."
+    try:
+        added, duplicates, errors = await items.catalog.import_sheet(dmsheet.url, tab)
+    except InvalidSheetException as e:
+        yield str(e)
+        return
+    result = f"Added {added} items, {duplicates} were already there!"
+    if errors:
+        result += "\nCouldn't import these rows:\n" + '\n'.join(errors[:20]) # Keeps the message under Discord's limit
+    yield result
+
+
 # Autocomplete
 @roll_dice.autocomplete('stat')
 async def stat_autocomplete(value):
-    if value is None:
-        return ROLLABLE_STATS
-    return [ROLLABLE_STAT for ROLLABLE_STAT in ROLLABLE_STATS if value.title() in ROLLABLE_STAT]
+    return ROLLABLE_STATS_INDEX.search(value)
 
 @roll_dice.autocomplete('mod')
 async def modifier_autocomplete(value):
-    if value is None:
-        return BASE_STATS
-    return [BASE_STAT for BASE_STAT in BASE_STATS if value.title() in BASE_STAT]
+    return BASE_STATS_INDEX.search(value)
 
 @monster_dex.autocomplete('monster')
 async def monster_autocomplete(value):
-    if value is None:
-        return dmsheet.MONSTER_LIST
-    return [MONSTER for MONSTER in dmsheet.MONSTER_LIST if value.title() in MONSTER]
+    return dmsheet.monster_index.search(value) # Rebuilt every time the MonsterDex changes
@@ -1,10 +1,13 @@
 from os import system
 from collections import namedtuple
+from functools import partial
 
-from hata import Role, Emoji, ERROR_CODES
+from hata import Role, Emoji, KOKORO
 from hata import DiscordException
 from hata.ext.extension_loader import EXTENSION_LOADER
 
+from ext.roles import RoleReconciler, RoleBatcher
+
 
 People = Role.precreate(902669243248697404)
 
@@ -18,72 +21,82 @@ Vigilante = RoleMoji('Vigilante', 'Vigilantes', Role.precreate(92512005065710802
 
 RoleMojis = (Hero, Villain, Antihero, Antivillain, Vigilante)
 
-@client.events
-async def ready(client):
-    info = "===__`User Roles`__===\n"
+ROLE_MESSAGE = (913148168756162590, 925140179516272660) # The message people react to for roles
+INFO_CHANNEL = 925141885213888583
+
+reconciler = RoleReconciler(client, ROLE_MESSAGE, RoleMojis)
+
+INFO_DELAY = 10 # Seconds to wait for more reactions before editing the info message
 
+async def update_info(): # Edits the "User Roles" message, posting a new one if it's gone
+    counts = misc['role_counts']
+    info = "===__`User Roles`__===\n"
     for rolemoji in RoleMojis:
-        for user in rolemoji.role.guild.users.values():
-            if user.has_role(rolemoji.role):
-                await client.user_role_delete(user, rolemoji.role, reason="Recalculating roles")
-
-        try:
-            await client.reaction_add((913148168756162590, 925140179516272660), rolemoji.emoji)
-        except DiscordException:
-            pass
-
-        reactors = await client.reaction_user_get_all((913148168756162590, 925140179516272660), rolemoji.emoji)
-        count = 0
-        for reactor in reactors:
-            if reactor.id == client.id or reactor.has_role(rolemoji.role):
-                continue
-            count +=1
-            try:
-                await client.user_role_add(reactor, rolemoji.role, reason="User reacted to "+rolemoji.name)
-            except DiscordException as err:
-                count -= 1
-                if err.code == ERROR_CODES.unknown_member:
-                    await client.reaction_delete((902668029115138078, misc['info']['message']), rolemoji.emoji, reactor)
-                else:
-                    raise
-        info += ("  - "+rolemoji.plural+" ⟩ " + str(count) + '\n')
+        info += ("  - "+rolemoji.plural+" ⟩ " + str(counts.get(rolemoji.name, 0)) + '\n')
     info += "\nNote: Users can have more than one role"
 
     try:
-        await client.message_edit((925141885213888583, misc['info'].get('message', 0)), info)
+        await client.message_edit((INFO_CHANNEL, misc['info'].get('message', 0)), info)
     except DiscordException:
-        misc['info']['message'] = (await client.message_create(925141885213888583, info)).id
-        misc.force_save()
+        misc['info']['message'] = (await client.message_create(INFO_CHANNEL, info)).id
+        misc.touch('info')
 
-@client.events
-async def reaction_add(client, event):
-    if not event.message.id == 925140179516272660:
-        return
+info_handle = None
 
-    rolemoji = None
-    for re in RoleMojis:
-        if re.emoji.id == event.emoji.id:
-            rolemoji = re
+def schedule_info(): # Only the first change in a burst schedules an edit
+    global info_handle
+    if info_handle is None:
+        info_handle = KOKORO.call_after(INFO_DELAY, flush_info)
 
-    if not rolemoji:
-        return
+def flush_info():
+    global info_handle
+    info_handle = None
+    KOKORO.create_task(update_info())
 
-    await client.user_role_add(event.user, rolemoji.role, reason="User reacted to "+rolemoji.name)
+def save_counts(counts): # Takes the counts RoleReconciler returns
+    misc['role_counts'] = {rolemoji.name: count for rolemoji, count in counts.items()}
 
-@client.events
-async def reaction_delete(client, event):
-    if not event.message.id == 925140179516272660:
+def count_reaction(rolemoji, change):
+    counts = misc.get('role_counts')
+    if counts is None: # Not counted yet, ready is about to count everything anyway
         return
+    counts[rolemoji.name] = max(counts.get(rolemoji.name, 0) + change, 0)
+    misc.touch('role_counts')
+    schedule_info()
 
-    rolemoji = None
-    for re in RoleMojis:
-        if re.emoji.id == event.emoji.id:
-            rolemoji = re
+@client.events
+async def ready(client):
+    if 'role_counts' not in misc: # First run, after that the reaction events keep the counts up to date
+        save_counts(await reconciler.run())
+    await update_info()
 
-    if not rolemoji:
+@client.interactions(guild=guilds)
+async def reconcile_roles(event):
+    """Makes everyone's reaction roles match their reactions and recounts them"""
+    if not client.is_owner(event.user):
+        yield "You don't have access to this command!"
         return
+    yield "Working out what needs changing..."
+
+    async def progress(done, total):
+        await client.interaction_response_message_edit(event, f"Reconciling roles... {done}/{total}")
+
+    save_counts(await reconciler.run(progress))
+    await update_info()
+    await client.interaction_response_message_edit(event, "Done, roles match the reactions again!")
+
+role_updates = RoleBatcher(client, HNDHQ) # Reaction spam turns into one role edit per member
+
+async def role_added(rolemoji, client, event):
+    role_updates.queue(event.user, rolemoji.role, True, "User reacted to "+rolemoji.name)
+    count_reaction(rolemoji, 1)
+
+async def role_removed(rolemoji, client, event):
+    role_updates.queue(event.user, rolemoji.role, False, "User removed reaction from `"+rolemoji.plural+"` group")
+    count_reaction(rolemoji, -1)
 
-    await client.user_role_delete(event.user, rolemoji.role, reason="User removed reaction from `"+rolemoji.plural+"` group")
+for rolemoji in RoleMojis:
+    reactions.add(ROLE_MESSAGE[1], rolemoji.emoji, partial(role_added, rolemoji), partial(role_removed, rolemoji))
 
 @client.interactions(guild=guilds)
 async def doing_your_mum():
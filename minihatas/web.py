@@ -1,93 +1,54 @@
 from os import environ
 from subprocess import getoutput
-from typing import Optional
 
-from hata import parse_oauth2_redirect_url, USERS, BUILTIN_EMOJIS
-from scarletio import enter_executor, AsyncIO
-from fastapi import Request, Cookie
-from starlette.responses import Response, HTMLResponse, RedirectResponse
+from hata import BUILTIN_EMOJIS, KOKORO
+from scarletio import enter_executor
 
-from ext.utils import Logger
+from ext.web import StaticAssets, PageRenderer, LocalBackend, add_routes, BACKEND_ACTIONS
+from ext.bridge import BridgeServer
 
 root = environ['ROOT_URL']
 url = environ['OAUTH']
 
-MIDs = []
-
 tick = BUILTIN_EMOJIS['white_check_mark']
 cross = BUILTIN_EMOJIS['x']
 
 
-with open('favicon.ico', 'rb') as f:
-    favicon_response = Response(content=f.read(), media_type='image/x-icon', status_code=200)
-
-@app.get('/')
-async def home(req:Request, user_id:Optional[int]=Cookie(False)):
-    if not user_id:
-        response = RedirectResponse(url=url)
-        response.set_cookie(key='redir', value='/', expires=360)
-        return response
-    return templates.TemplateResponse("index.html", {"request":req, "name":USERS.get(user_id, "Unknown").full_name})
-
-@app.get('/static/{path:path}', include_in_schema=False)
-async def static(path:str):
-    with await AsyncIO('static/'+path) as f:
-        if path.endswith('.less'):
-            return Response(content=(await f.read()), media_type='text/css', status_code=200)
-        elif path.endswith('.js'):
-            return Response(content=(await f.read()), media_type='text/javascript', status_code=200)
-        return Response(content=(await f.read()), media_type='text/plain', status_code=200)
-
-@app.get('/favicon.ico', include_in_schema=False)
-async def favicon():
-    return favicon_response
-
-@app.get('/authorise')
-async def authorise():
-    return RedirectResponse(url=url)
-
-@app.get('/callback')
-async def authorised(redir:Optional[str]=Cookie('/'), code:str=None):
-    Logger.debug('OAuth code', code)
-    if not code:
-        return HTMLResponse(f"""<h1>Invalid Access Code!</h1>
-            <p>To login, go to <a href={root}/authorise>the OAuth page</>!</p>""")
-    oauth_access = await client.activate_authorization_code(root+'/callback', code, 'identify')
-    user = await client.user_info_get(oauth_access)
-    response = RedirectResponse(url=redir)
-    response.set_cookie(key='user_id', value=user.id, expires=360)
-    Logger.debug('Authorised User', user.id, '|', user.name)
-    return response
+assets = StaticAssets('static', watch=bool(environ.get('DEBUG'))) # Everything under static/ is loaded (and LESS compiled) once, here
+templates.env.globals['static_url'] = assets.url
+pages = PageRenderer(templates, static=('logout.html',))
 
-@app.get('/logout')
-async def logout(req:Request):
-    response = templates.TemplateResponse("logout.html", {"request":req})
-    response.set_cookie(key="user_id", value=0, expires=1)
-    return response
-
-@app.post('/github', include_in_schema=False)
-async def update():
+async def announce_update():
     msg = await client.message_create(environ['LOGGING_CHANNEL'], "New commit pushed to GitHub! Would you like to update?")
-    MIDs.append(msg.id)
+    reactions.add(msg.id, tick, update_chosen)
+    reactions.add(msg.id, cross, update_chosen)
     await client.reaction_add(msg, tick)
     await client.reaction_add(msg, cross)
-    return {}
 
-@client.events
-async def reaction_add(client, event):
-    if event.user.id == client.id:
-        return
-    if not client.is_owner(event.user) and event.emoji in (tick, cross):
+backend = LocalBackend(client, sessions, chars, root, announce_update)
+add_routes(app, backend, assets, pages, root, url)
+
+# With BRIDGE_SOCKET set the dashboard can also run as separate worker processes (see webworker.py), they reach the bot through this
+bridge = None
+if environ.get('BRIDGE_SOCKET'):
+    bridge = BridgeServer(backend, environ['BRIDGE_SOCKET'], BACKEND_ACTIONS)
+    KOKORO.create_task_thread_safe(bridge.start())
+
+def teardown(lib): # Called by the extension loader before a reload, frees the socket for the new bridge
+    if bridge is not None:
+        bridge.close()
+
+async def update_chosen(client, event): # Someone reacted to an update message with the tick or the cross
+    if not client.is_owner(event.user):
         await client.message_create(event.message.channel, "You don't have permission to do this!!")
         await client.reaction_remove(event.message, event.emoji, event.user)
-    if event.message.id not in MIDs:
         return
-    del MIDs[MIDs.index(event.message.id)]
+    reactions.remove(event.message.id)
     await client.reaction_clear(event.message)
     if event.emoji is tick:
         await client.message_edit(event.message, "Pulling changes from GitHub now...")
         async with enter_executor():
             output = getoutput('git pull')
         await client.message_edit(event.message, "Done, here is the output:"+'```sh\n'+output+'```')
-    elif event.emoji is cross:
+    else:
         await client.message_edit(event.message, "Ignoring latest commit from git.")
@@ -0,0 +1,11 @@
+from os import environ
+
+from ext.loop import kokoro_asyncio, stop_kokoro
+
+kokoro_asyncio()
+
+environ.setdefault('DM_SHEET', 'https://docs.google.com/spreadsheets/d/tests') # ext.utils makes the DMSheet on import
+
+
+def pytest_sessionfinish(session, exitstatus):
+    stop_kokoro()
@@ -0,0 +1,26 @@
+from ext.utils import AutocompleteIndex
+
+
+MONSTERS = ["Goblin", "Goblin Shaman", "Hobgoblin", "Red Dragon", "Dragon Turtle", "Dracolich", "Troll", "Ogre"]
+
+
+def test_prefix_then_substring():
+    index = AutocompleteIndex(MONSTERS)
+    assert index.search("gob") == ["Goblin", "Goblin Shaman", "Hobgoblin"]
+    assert index.search("") == MONSTERS
+    assert AutocompleteIndex(MONSTERS, limit=2).search("gob") == ["Goblin", "Goblin Shaman"]
+
+
+def test_fuzzy_handles_typos():
+    index = AutocompleteIndex(MONSTERS)
+    assert sorted(index.search("drgaon")) == ["Dragon Turtle", "Red Dragon"] # Swapped letters
+    assert index.search("trol") == ["Troll"]
+    assert index.search("tlorl") == [] # Too far off for five letters
+    assert "Hobgoblin" in index.search("hobgbolin")
+
+
+def test_typos():
+    assert AutocompleteIndex._typos("dragon", "red dragon", 2) == 0
+    assert AutocompleteIndex._typos("drgaon", "red dragon", 2) == 1
+    assert AutocompleteIndex._typos("dragn", "red dragon", 2) == 1
+    assert AutocompleteIndex._typos("xyzzy", "red dragon", 2) == 3 # Gives up past what's allowed
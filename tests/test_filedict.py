@@ -0,0 +1,165 @@
+from os.path import exists, getsize, getmtime
+from io import StringIO
+from types import SimpleNamespace as SN
+
+import pytest
+from hata import KOKORO
+
+from ext.utils import FileDict, new_yaml
+from ext.web import SnapshotReader
+from tests.test_inventory import make_character
+
+
+def run(fd, change): # Changes a FileDict on the event loop like the bot does, then writes everything out
+    async def main():
+        change(fd)
+        await fd.flush()
+    KOKORO.run(main())
+
+
+def same(a, b): # Characters don't compare by value, their YAML does (it sorts attributes, so the order they were set in doesn't matter)
+    return dump(dict(a)) == dump(dict(b))
+
+
+def dump(data):
+    buffer = StringIO()
+    dumper = new_yaml()
+    dumper.representer.ignore_aliases = lambda data: True # Objects shared between characters (like constant tuples) aren't shared after a reload
+    dumper.dump(data, buffer)
+    return buffer.getvalue()
+
+
+def records(journal): # Where every record in a journal ends
+    with open(journal, 'rb') as f:
+        raw = f.read()
+    ends = []
+    end = 0
+    while end < len(raw):
+        newline = raw.index(b'\n', end)
+        end = newline + 1 + int(raw[end:newline].split(b' ')[0])
+        ends.append(end)
+    return raw, ends
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'characters.yaml')
+
+
+def test_journal_round_trip(path):
+    fd = FileDict('{}', path, compact_after=1000)
+    run(fd, lambda fd: fd.update({1: make_character(), 2: make_character(15), 3: SN(name="three")}))
+    run(fd, lambda fd: fd.pop(2))
+
+    def rename(fd): # Changed in place, so it has to be touched
+        fd[1].name = "Renamed"
+        fd.touch(1)
+    run(fd, rename)
+    assert fd.records == 5 and exists(fd.journal)
+
+    loaded = FileDict('{}', path)
+    assert loaded.records == 5
+    assert sorted(loaded) == [1, 3]
+    assert loaded[1].name == "Renamed"
+    assert same(loaded, fd)
+
+
+@pytest.mark.parametrize('cut', ['header', 'lines', 'byte'])
+def test_torn_tail_is_dropped_and_truncated(path, cut):
+    fd = FileDict('{}', path, compact_after=1000)
+    run(fd, lambda fd: fd.update({1: make_character(), 2: make_character(12)}))
+    run(fd, lambda fd: fd.__setitem__(3, make_character(18)))
+    raw, ends = records(fd.journal)
+    last = raw[ends[1]:]
+    if cut == 'header':
+        cuts = [ends[1] + 2]
+    elif cut == 'lines': # Every line boundary inside the last record, like a write cut short between lines
+        cuts = [ends[1] + i + 1 for i, byte in enumerate(last[:-1]) if byte == ord('\n')]
+    else:
+        cuts = [len(raw) - 1]
+    assert cuts
+
+    for size in cuts:
+        with open(fd.journal, 'wb') as f:
+            f.write(raw[:size])
+        loaded = FileDict('{}', path)
+        assert sorted(loaded) == [1, 2] # The torn character is gone instead of half loaded
+        assert same(loaded, {1: fd[1], 2: fd[2]})
+        assert getsize(fd.journal) == ends[1] # Back to the last whole record
+
+    run(loaded, lambda fd: fd.__setitem__(4, SN(name="four"))) # Appending after the repair still replays
+    assert sorted(FileDict('{}', path)) == [1, 2, 4]
+
+
+def test_corrupt_record_only_loses_itself(path):
+    fd = FileDict('{}', path, compact_after=1000)
+    for key in (1, 2, 3):
+        run(fd, lambda fd: fd.__setitem__(key, SN(name=f"number {key}")))
+    raw, ends = records(fd.journal)
+    broken = bytearray(raw)
+    broken[ends[1] - 3] ^= 0xff # Inside the second record
+    with open(fd.journal, 'wb') as f:
+        f.write(broken)
+
+    loaded = FileDict('{}', path)
+    assert loaded.records == 2
+    assert sorted(loaded) == [1, 3]
+    assert getsize(fd.journal) == len(raw) # Nothing torn at the end, so nothing truncated
+
+
+@pytest.mark.parametrize('publish', [False, True])
+def test_compaction_round_trip(path, publish):
+    fd = FileDict('{}', path, compact_after=3, publish=publish)
+    for key in range(7):
+        run(fd, lambda fd: fd.__setitem__(key, make_character(10 + key)))
+        if key == 2: # The third record folded everything into the snapshot
+            assert not exists(fd.journal) and fd.records == 0
+    run(fd, lambda fd: fd.pop(0))
+    assert fd.records == 2 # Keys 6 and the delete since the last compaction
+
+    loaded = FileDict('{}', path)
+    assert sorted(loaded) == list(range(1, 7))
+    assert same(loaded, fd)
+
+    fd.force_save()
+    assert not exists(fd.journal)
+    assert same(FileDict('{}', path), fd)
+
+
+def test_unframed_journal_is_folded_in(path):
+    with open(path + '.journal', 'w') as f: # What journals looked like before records were framed
+        f.write("---\nop: set\nkey: 1\nvalue: one\n---\nop: set\nkey: 2\nvalue: two\n---\nop: del\nkey: 1\n---\nop: set\nkey: 3\n")
+
+    fd = FileDict('{}', path)
+    assert dict(fd) == {2: 'two'} # The torn last record is skipped
+    assert not exists(fd.journal)
+    run(fd, lambda fd: fd.__setitem__(4, 'four'))
+    assert dict(FileDict('{}', path)) == {2: 'two', 4: 'four'}
+
+
+def test_snapshot_reader_follows_the_journal(path):
+    fd = FileDict('{}', path, compact_after=4, publish=True)
+    reader = SnapshotReader(path, interval=0)
+    assert reader.get(1) is None
+    published = getmtime(fd.binary)
+
+    run(fd, lambda fd: fd.update({1: SN(name="one"), 2: SN(name="two")}))
+    assert reader.get(1).name == "one"
+    assert getmtime(fd.binary) == published # Only the journal was written to
+
+    run(fd, lambda fd: fd.pop(1))
+    run(fd, lambda fd: fd.__setitem__(3, SN(name="three"))) # The fourth record, compacted
+    assert not exists(fd.journal)
+    reader.get(2)
+    assert sorted(reader.data) == [2, 3]
+
+    run(fd, lambda fd: fd.__setitem__(2, SN(name="changed"))) # A new journal
+    assert reader.get(2).name == "changed"
+    reader.get(2)
+    assert reader.offset == getsize(fd.journal) # Nothing read twice
+
+    def rename(fd): # Not touched, only force_save writes it
+        fd[2].name = "saved"
+    run(fd, rename)
+    fd.force_save()
+    assert reader.get(2).name == "saved"
@@ -0,0 +1,84 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+from time import sleep
+import socket
+
+from hata import KOKORO
+
+from ext.httpclient import HTTPClient
+
+
+class StubHandler(BaseHTTPRequestHandler): # /ok answers 200, /nohead only does GET, /slow takes a second, anything else is a 404
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', self.path))
+        if self.path == '/nohead':
+            self._reply(405)
+        elif self.path == '/slow':
+            sleep(1)
+            self._reply(200)
+        else:
+            self._reply(200 if self.path.startswith('/ok') else 404)
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path))
+        self._reply(200 if self.path in ('/ok', '/nohead') else 404)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args): # Keeps the test output clean
+        pass
+
+
+def serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.requests = []
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def check(client, *urls):
+    async def main():
+        try:
+            return [await client.url_ok(url) for url in urls]
+        finally:
+            await client.aclose()
+    return KOKORO.run(main())
+
+
+def test_url_ok():
+    server, root = serve()
+    try:
+        assert check(HTTPClient(), root+'/ok', root+'/missing', root+'/nohead') == [True, False, True]
+        assert server.requests == [('HEAD', '/ok'), ('HEAD', '/missing'), ('HEAD', '/nohead'), ('GET', '/nohead')] # GET only for the host without HEAD
+    finally:
+        server.shutdown()
+
+
+def test_url_ok_is_cached():
+    server, root = serve()
+    try:
+        assert check(HTTPClient(), root+'/ok', root+'/missing', root+'/ok', root+'/missing') == [True, False, True, False]
+        assert len(server.requests) == 2
+
+        client = HTTPClient(size=2)
+        check(client, root+'/ok1', root+'/ok2', root+'/ok3')
+        assert list(client.checks) == [root+'/ok2', root+'/ok3'] # The oldest was dropped
+        check(client, root+'/ok1')
+        assert len(server.requests) == 6 # So it's checked again
+    finally:
+        server.shutdown()
+
+
+def test_url_ok_failures():
+    server, root = serve()
+    with socket.socket() as sock: # A port nothing listens on
+        sock.bind(('127.0.0.1', 0))
+        closed = f'http://127.0.0.1:{sock.getsockname()[1]}/ok'
+    try:
+        assert check(HTTPClient(timeout=0.2), root+'/slow', closed, None) == [False, False, False]
+    finally:
+        server.shutdown()
@@ -0,0 +1,131 @@
+from random import Random
+from types import SimpleNamespace as SN
+
+import pytest
+
+from ext.utils import Character, Inventory, Item, Arrow, PreciousMaterial, InventoryFullError, SNAPSHOT, Size
+
+
+def make_character(strength=10, size='medium'):
+    stats = SN(str=strength, dex=10, con=10, int=10, wis=10, cha=10)
+    return Character("Test", "Human", "brown", "black", 20, "female", ("is", "has"), ("she", "her", "herself"), "5'6\"", "130 lbs", 1, 30, None, 100, stats, stats, size)
+
+
+def random_item(rng):
+    kind = rng.randrange(3)
+    if kind == 0:
+        item = Item(f"Item {rng.random()}", rng.choice((0.5, 1, 2.5, 10)))
+    elif kind == 1:
+        item = Arrow("Arrow")
+    else:
+        item = PreciousMaterial("Gem", 0, rng.choice((50, 500, 1000)))
+    item.amount = rng.randint(1, 5)
+    return item
+
+
+# Worked out from scratch, the way Character did before it kept running totals
+def recount_weight(inventory):
+    return inventory.weight + sum(item.weight * item.amount for item in inventory.inv)
+
+def recount_value(inventory):
+    return sum(item.value * item.amount for item in inventory.inv if isinstance(item, PreciousMaterial))
+
+def recount_total(char):
+    names = ['body_inv', 'belt_pouch', 'quiver', 'gems', 'valuables'] + (['backpack'] if char.bpa else [])
+    return sum(recount_weight(getattr(char, name)) for name in names) + (char.bag_of_holding.weight if char.boha else 0)
+
+def recount_encumbrance(char):
+    total = recount_total(char)
+    strength = char.stats.base.str * getattr(Size, char.size)
+    for limit, result in ((15, "M"), (10, "H"), (5, "L")):
+        if total > strength * limit:
+            return result
+    return "N"
+
+
+def test_inventory_totals_follow_adds_and_removals():
+    rng = Random(0)
+    inventory = Inventory(0, 3)
+    for _ in range(2000):
+        if inventory.inv and rng.random() < 0.4:
+            if rng.random() < 0.5:
+                inventory.pop(rng.randrange(len(inventory.inv)))
+            else:
+                inventory.remove(rng.choice(inventory.inv))
+        else:
+            inventory.add(random_item(rng))
+        assert inventory.inv_e == pytest.approx(recount_weight(inventory))
+        assert inventory.value == recount_value(inventory)
+
+
+def test_recount_picks_up_changed_amounts():
+    inventory = Inventory(0)
+    item = Item("Rope", 10)
+    inventory.add(item)
+    item.amount = 3
+    inventory.recount()
+    assert inventory.inv_e == recount_weight(inventory) == 30
+
+
+def test_full_inventory_keeps_its_totals():
+    inventory = Inventory(1)
+    inventory.add(Item("Rope", 10))
+    with pytest.raises(InventoryFullError):
+        inventory.add(Item("Torch", 1))
+    assert inventory.inv_e == recount_weight(inventory) == 10
+
+
+def test_character_aggregates_match_recomputed_values():
+    rng = Random(1)
+    for trial in range(200):
+        char = make_character(rng.randint(1, 20), rng.choice(('tiny', 'small', 'medium', 'large', 'huge')))
+        char.bpa = rng.random() < 0.5
+        char.boha = rng.random() < 0.5
+        for _ in range(rng.randint(0, 12)):
+            name = rng.choice(Character.INVENTORIES)
+            try:
+                getattr(char, name).add(random_item(rng))
+            except InventoryFullError:
+                pass
+        if rng.random() < 0.5 and char.body_inv.inv:
+            char.body_inv.pop()
+
+        assert char.inv_total_e == pytest.approx(recount_total(char))
+        assert char.wealth == char.yen + recount_value(char.gems) + recount_value(char.valuables)
+        assert char.encumbered_calc == recount_encumbrance(char)
+
+
+def test_untouched_inventories_are_not_made():
+    char = make_character()
+    assert char.inv_total_e == recount_total(make_character())
+    assert char.wealth == 100
+    for name in Character.INVENTORIES:
+        assert getattr(char, '_' + name, None) is None
+
+
+def test_totals_survive_a_snapshot():
+    char = make_character()
+    char.body_inv.add(Item("Rope", 10, amount=2))
+    char.gems.add(PreciousMaterial("Ruby", 0, 500))
+    loaded = SNAPSHOT.loads(SNAPSHOT.dumps({1: char}))[1]
+    assert loaded.body_inv.items_weight == 20 # Worked out again by __setstate__, they aren't saved
+    assert loaded.inv_total_e == recount_total(char)
+    assert loaded.wealth == char.wealth == 600
+
+
+def test_size_scales_encumbrance():
+    small = make_character(10, 'tiny')
+    large = make_character(10, 'large')
+    for char in (small, large):
+        char.body_inv.add(Item("Anvil", 120)) # 122lbs with the belt pouch and quiver
+    assert small.encumbered_calc == "M" # Over 10 * 0.5 * 15
+    assert large.encumbered_calc == "L" # Over 10 * 2 * 5 but not 10 * 2 * 10
+    assert large._get_max_e == 300
+
+
+def test_characters_without_a_size_count_as_medium():
+    char = make_character()
+    del char.size # Saved before sizes were kept
+    assert char.size_multiplier == 1
+    char.size = "not a size"
+    assert char.size_multiplier == 1
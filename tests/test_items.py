@@ -0,0 +1,91 @@
+from types import SimpleNamespace as SN
+
+import pytest
+from hata import KOKORO
+from gspread.exceptions import APIError
+
+import ext.utils
+from ext.utils import ItemCatalog, Item, Arrow, SheetRanges, InvalidSheetException, ITEM_RANGE
+
+
+class Store(dict): # Stands in for the items FileDict, remembering what got touched
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.touched = []
+
+    @property
+    def data(self):
+        return self
+
+    def touch(self, key):
+        self.touched.append(key)
+
+
+def test_names_are_unique_per_kind_ignoring_case():
+    catalog = ItemCatalog(Store({'items': [Item("Rope", 10)]}))
+    assert catalog.get("rOPE").name == "Rope"
+    assert "ROPE" in catalog
+    assert not catalog.add('items', Item("rope", 5))
+    assert catalog.add('arrows', Arrow("Rope")) # Another kind, so it's not a duplicate
+    assert catalog.get("rope", 'arrows').weight == 0.05
+    assert catalog.add('items', Item("Torch", 1))
+    assert [item.name for item in catalog.store['items']] == ["Rope", "Torch"]
+    assert catalog.store.touched == ['arrows', 'items']
+
+
+def test_rarity_index():
+    catalog = ItemCatalog(Store({'items': [Item("Potion", 0.5, rarity="Common")]}))
+    catalog.add('items', Item("Sword", 3, rarity="Rare"))
+    catalog.add('items', Item("Elixir", 0.5, rarity="Rare"))
+    catalog.add('items', Item("Pebble", 0.1))
+    assert [item.name for item in catalog.of_rarity("Rare")] == ["Sword", "Elixir"]
+    assert [item.name for item in catalog.of_rarity("Common")] == ["Potion"]
+    assert catalog.of_rarity("Legendary") == []
+    with pytest.raises(ValueError):
+        catalog.add('items', Item("Thing", 1, rarity="Shiny"))
+    assert "Thing" not in catalog
+
+
+def test_bad_rows():
+    catalog = ItemCatalog(Store())
+    kind, item = catalog.item_from_row("Healing Potion", "item", "0.5", "", "uncommon", "2d4", "heal", "self")
+    assert kind == 'items' and item.rarity == "Uncommon" and item.weight == 0.5
+    assert catalog.item_from_row("Ruby", "Valuable", "", "500", "", "", "", "")[0] == 'valuables'
+    for row in (
+      ("Thing", "furniture", "", "", "", "", "", ""), # No such type
+      ("Thing", "item", "", "", "shiny", "", "", ""), # No such rarity
+      ("Thing", "item", "heavy", "", "", "", "", ""), # Weight isn't a number
+    ):
+        with pytest.raises(ValueError):
+            catalog.item_from_row(*row)
+
+
+def test_import_sheet(monkeypatch):
+    rows = [["Rope", "item", "10"], ["rope", "item", "5"], ["Thing", "furniture"], [], ["Arrow", "arrow"]] + [[]] * 600 + [["Ruby", "valuable", "", "500"]]
+
+    async def open(url):
+        return None
+
+    async def batch_get(doc, ranges): # The Items tab, everything past row 500 included
+        sheet, tab, rng = ranges[0]
+        if tab != 'Items':
+            raise APIError(SN(status_code=400, json=lambda: {'error': {'code': 400, 'message': "Unable to parse range", 'status': "INVALID_ARGUMENT"}}, text=""))
+        sheet.add({'range': f"'{tab}'!{rng}", 'values': rows})
+
+    monkeypatch.setattr(ext.utils.SHEETS, 'open', open)
+    monkeypatch.setattr(ext.utils, 'batch_get', batch_get)
+    catalog = ItemCatalog(Store())
+    added, duplicates, errors = KOKORO.run(catalog.import_sheet('url'))
+    assert (added, duplicates) == (3, 1)
+    assert errors == ["Thing: type has to be one of item, arrow, valuable"]
+    assert catalog.get("Ruby").value == 500
+
+    with pytest.raises(InvalidSheetException):
+        KOKORO.run(catalog.import_sheet('url', 'Itmes'))
+
+
+def test_rows_reads_to_the_last_row():
+    sheet = SheetRanges()
+    sheet.add({'range': "'Items'!A2:H1000", 'values': [["a", "b"], [], ["c", "", "", "", "", "", "", "h"]]})
+    assert sheet.rows(ITEM_RANGE) == [["a", "b", "", "", "", "", "", ""], [""] * 8, ["c", "", "", "", "", "", "", "h"]]
+    assert SheetRanges().rows(ITEM_RANGE) == []
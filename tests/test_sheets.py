@@ -0,0 +1,150 @@
+from time import sleep, perf_counter
+from json import dumps
+from urllib.parse import urlsplit, parse_qs
+import inspect
+
+from hata import KOKORO
+from requests import Session, Response
+from requests.adapters import BaseAdapter
+import gspread
+import gspread_asyncio
+
+from ext.loop import kokoro_asyncio
+from ext.utils import SheetsManager, SheetsSession, SheetRanges, batch_get
+
+asyncio = kokoro_asyncio()
+
+
+class SlowTransport(BaseAdapter): # Stands in for Google, every request blocks its thread for `latency` seconds like a slow round trip
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.requests = 0
+
+    def send(self, request, **kwargs):
+        sleep(self.latency)
+        self.requests += 1
+        url = urlsplit(request.url)
+        key = url.path.split('/')[3].split(':')[0]
+        if url.path.endswith('values:batchGet'):
+            body = {'spreadsheetId': key, 'valueRanges': [{'range': rng, 'values': [[rng]]} for rng in parse_qs(url.query)['ranges']]}
+        else:
+            body = {'spreadsheetId': key, 'properties': {'title': key}, 'sheets': []}
+        response = Response()
+        response.status_code = 200
+        response._content = dumps(body).encode()
+        response.headers['Content-Type'] = 'application/json'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def open_stub(latency):
+    session = Session()
+    transport = SlowTransport(latency)
+    session.mount('https://', transport)
+    client = gspread_asyncio.AsyncioGspreadClient(SheetsManager(None, asyncio.Semaphore(4)), gspread.Client(None, session=session))
+    return client, transport
+
+
+def test_batch_get_keeps_the_loop_responsive():
+    async def main():
+        client, transport = open_stub(0.3)
+        doc = await client.open_by_key('stub')
+        sheet = SheetRanges()
+        gaps = []
+
+        async def ticker(): # Notes how late every 10ms tick is, a blocked loop shows up as one long gap
+            last = perf_counter()
+            while True:
+                await asyncio.sleep(0.01)
+                now = perf_counter()
+                gaps.append(now - last)
+                last = now
+
+        ticks = asyncio.ensure_future(ticker())
+        try:
+            await batch_get(doc, [(sheet, 'Front', 'B1'), (sheet, 'Front', 'B3')])
+        finally:
+            ticks.cancel()
+        return sheet, gaps, transport
+
+    sheet, gaps, transport = KOKORO.run(main())
+    assert sheet.value('B1') == "'Front'!B1"
+    assert sheet.value('B3') == "'Front'!B3"
+    assert transport.requests == 2 # Opening the doc, then a single batchGet for both ranges
+    assert len(gaps) >= 10 # The loop kept ticking for the whole 0.3s request
+    assert max(gaps) < 0.1
+
+
+def test_batch_gets_run_at_once():
+    async def main():
+        client, transport = open_stub(0.2)
+        docs = [await client.open_by_key(f'stub{i}') for i in range(4)]
+        start = perf_counter()
+        await asyncio.gather(*(batch_get(doc, [(SheetRanges(), 'Front', 'A1')]) for doc in docs))
+        return perf_counter() - start
+
+    assert KOKORO.run(main()) < 0.4 # Four 0.2s requests, one after another would take 0.8s
+
+
+def test_gspread_asyncio_still_routes_through_call(): # SheetsManager overrides a private method, this catches an upgrade that stops calling it
+    base = inspect.signature(gspread_asyncio.AsyncioGspreadClientManager._call)
+    assert list(base.parameters)[:2] == ['self', 'method']
+    assert hasattr(gspread_asyncio.AsyncioGspreadClientManager, 'before_gspread_call')
+
+    calls = []
+
+    class Counting(SheetsManager):
+        async def _call(self, method, *args, **kwargs):
+            calls.append(method.__name__)
+            return await super()._call(method, *args, **kwargs)
+
+    async def main():
+        session = Session()
+        transport = SlowTransport(0)
+        session.mount('https://', transport)
+        client = gspread_asyncio.AsyncioGspreadClient(Counting(None, asyncio.Semaphore(4)), gspread.Client(None, session=session))
+        doc = await client.open_by_key('stub')
+        await batch_get(doc, [(SheetRanges(), 'Front', 'A1')])
+        return transport
+
+    transport = KOKORO.run(main())
+    assert calls == ['open_by_key', 'values_batch_get']
+    assert transport.requests == len(calls) # Nothing went around the limit and retries
+
+
+def test_sheets_session_drops_from_the_client_cache(): # SheetsSession works on gspread_asyncio's own spreadsheet caches, this catches an upgrade that renames them
+    client, transport = open_stub(0)
+
+    class Manager(object):
+        async def authorize(self):
+            return client
+
+    session = SheetsSession(Manager(), size=2, ttl=0.2)
+    url = 'https://docs.google.com/spreadsheets/d/{}/edit'.format
+
+    async def main():
+        doc = await session.open(url('a'))
+        assert await session.open(url('a')) is doc
+        assert transport.requests == 1
+        assert isinstance(doc.ss, gspread.Spreadsheet) and hasattr(doc.ss, 'get_lastUpdateTime') # What sheet_modified calls
+
+        await asyncio.sleep(0.25)
+        await session.open(url('a')) # Too old, its metadata is fetched again
+        assert transport.requests == 2
+
+        await session.open(url('b'))
+        await session.open(url('c'))
+        assert list(session.docs) == ['b', 'c']
+        assert sorted(client._ss_cache_key) == ['b', 'c'] and sorted(client._ss_cache_title) == ['b', 'c']
+
+        session.forget(url('b'))
+        assert list(session.docs) == ['c'] and list(client._ss_cache_key) == ['c']
+        await session.open(url('b'))
+        assert transport.requests == 5
+
+    KOKORO.run(main())
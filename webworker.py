@@ -0,0 +1,24 @@
+from os import environ
+
+from fastapi import FastAPI
+from fastapi.templating import Jinja2Templates
+
+from ext.loop import stop_kokoro
+from ext.web import StaticAssets, PageRenderer, BridgeBackend, SnapshotReader, add_routes
+from ext.bridge import BridgeClient
+
+# The dashboard on its own, so it can use every core without slowing down the gateway:
+#   uvicorn webworker:app --workers 4 --port 8080
+# The bot has to be running with the same BRIDGE_SOCKET, and from the same directory so the character snapshot is found
+
+app = FastAPI()
+templates = Jinja2Templates(directory="templates")
+
+assets = StaticAssets('static', watch=bool(environ.get('DEBUG')))
+templates.env.globals['static_url'] = assets.url
+pages = PageRenderer(templates, static=('logout.html',))
+
+backend = BridgeBackend(BridgeClient(environ['BRIDGE_SOCKET']), SnapshotReader('characters.yaml'))
+add_routes(app, backend, assets, pages, environ['ROOT_URL'], environ['OAUTH'])
+
+app.on_event('shutdown')(stop_kokoro)